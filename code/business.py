@@ -13,30 +13,98 @@
 # limitations under the License.
 
 import usys
-from usr.protocol import RFC1662ProtocolResolver
+from usr.protocol import RFC1662ProtocolResolver, TransactionManager
+from usr.constant import COSEM, COSEM_ACK, CLASS18_IMAGE_PARAM_ID
 from usr.qframe.logging import getLogger
 import ustruct as struct
 from usr.qframe.threading import Thread
-from usr.protocol import RFC1662Protocol
+from usr.protocol import RFC1662Protocol, DownlinkReassembly, dlms_destination
+from usr.image import ImageTransfer
 from usr.qframe import CurrentApp
-from usr.qframe import Uart, TcpClient
+from usr.qframe import Uart, TcpClient, UdpClient, TcpServer, Aggregator, Poller, MeterBus
 
 
 logger = getLogger(__name__)
 
 
+def pdu_to_meter(pdu, segments):
+    """send one HES PDU to the meter, through the RS485 bus scheduler if there is one"""
+    app = CurrentApp()
+    frames = [RFC1662Protocol.build_rfc_0x2100(segment) for segment in segments]
+    if 'bus' in app.extensions:
+        app.bus.submit(dlms_destination(pdu), frames)
+    else:
+        for frame in frames:
+            app.uart.write(frame)
+
+
+def client_to_meter(client, data):
+    """reassemble data received by a cloud client and send to uart, one 0x2100 frame per PDU segment"""
+    app = CurrentApp()
+    for pdu in client.reassembler.feed(data):
+        if 'server' in app.extensions and not app.server.acquire(client):
+            # mix mode, meter is busy with a server session
+            logger.warn('meter busy with {}, drop client data.'.format(app.server.owner))
+            continue
+        pdu_to_meter(pdu, client.reassembler.split(pdu))
+
+
 class BusinessClient(TcpClient):
 
+    def init_app(self, app):
+        self.reassembler = app.downlink.new()
+        super().init_app(app)
+
     def recv_callback(self, data):
         # recv tcp data and send to uart
-        data = RFC1662Protocol.build_rfc_0x2100(data)
-        CurrentApp().uart.write(data)
+        client_to_meter(self, data)
 
 
 # tcp client, recv/send tcp data
 client = BusinessClient('client')
 
 
+class BusinessUdpClient(UdpClient):
+
+    def init_app(self, app):
+        self.reassembler = app.downlink.new()
+        super().init_app(app)
+
+    def recv_callback(self, data):
+        # recv udp data and send to uart
+        client_to_meter(self, data)
+
+
+# udp client, drop-in replacement of `client` when TRANSPORT is "udp"
+udp_client = BusinessUdpClient('client')
+
+
+class BusinessServer(TcpServer):
+
+    def __init__(self, name, app=None, recv_buf_size=1024):
+        # one downlink reassembler per session
+        self.reassemblers = {}
+        super().__init__(name, app=app, recv_buf_size=recv_buf_size)
+
+    def close_session(self, session):
+        super().close_session(session)
+        reassembler = self.reassemblers.pop(session, None)
+        if reassembler is not None:
+            CurrentApp().downlink.release(reassembler)
+
+    def recv_callback(self, session, data):
+        # recv tcp data from the session owning the meter and send to uart, one 0x2100 frame per PDU segment
+        reassembler = self.reassemblers.get(session)
+        if reassembler is None:
+            reassembler = self.reassemblers[session] = CurrentApp().downlink.new()
+        for pdu in reassembler.feed(data):
+            pdu_to_meter(pdu, reassembler.split(pdu))
+
+
+# tcp server, accept HES connections polling the meter
+server = BusinessServer('server')
+
+
 class UartBusiness(Uart):
 
     def __init__(self, name, app=None):
@@ -106,10 +174,54 @@ class UartBusiness(Uart):
 uart = UartBusiness('uart')
 
 
+class RS485Bus(MeterBus):
+
+    def write_callback(self, address, frames):
+        uart = CurrentApp().uart
+        for frame in frames:
+            uart.write(frame)
+
+
+# several meters sharing the RS485 bus, enabled by RS485_BUS
+bus = RS485Bus('bus')
+
+
+class UplinkAggregator(Aggregator):
+
+    def flush_callback(self, batch):
+        CurrentApp().client.send_async(batch)
+
+
+# uplink aggregation between resolver and cloud client, enabled by UPLINK_BATCH
+aggregator = UplinkAggregator('aggregator')
+
+
+class MeterPoller(Poller):
+
+    def poll_callback(self, param_ids, groups):
+        # read params of due groups in one batch, values land in the param cache
+        results = CurrentApp().transactions.batch_get(param_ids)
+        failed = [hex(param_id) for param_id, (status, _) in results.items() if status != COSEM_ACK.SUCCESS]
+        if failed:
+            logger.warn('poll {} failed params: {}'.format(groups, failed))
+
+
+# periodic meter polling, enabled by POLLING
+poller = MeterPoller('poller')
+
+
 # rfc1662 protocol data resovler
 rfc1662resolver = RFC1662ProtocolResolver()
 
 
+# module to meter 0x2200 request/response correlation
+transactions = TransactionManager()
+
+
+# downlink PDU reassembly for the cloud client and server sessions
+downlink = DownlinkReassembly()
+
+
 # >>>>>>>>>> handle rfc1662 message received from uart <<<<<<<<<<
 
 @rfc1662resolver.register(0x2100)
@@ -117,4 +229,32 @@ def handle2100(msg):
     """post data received to cloud"""
     data = msg.info().request_data()
     if data:
-        CurrentApp().client.send(data)
+        app = CurrentApp()
+        if 'bus' in app.extensions:
+            # meter answered, release the bus for the next request
+            app.bus.complete()
+        if 'server' in app.extensions and app.server.send(data) is not None:
+            # answer goes to the server session owning the meter
+            return
+        if 'aggregator' in app.extensions:
+            app.aggregator.put(data)
+        elif 'client' in app.extensions:
+            app.client.send_async(data)
+
+
+@rfc1662resolver.register(0x2200)
+def handle2200(msg):
+    """complete pending module to meter transactions, answer image pulls of the meter"""
+    if msg.cmd() == COSEM.GET and msg.info().param_id() in (
+            CLASS18_IMAGE_PARAM_ID.IMAGE_TRANSFER_INITIATE, CLASS18_IMAGE_PARAM_ID.IMAGE_BLOCK_TRANSFER):
+        transfer = ImageTransfer.active
+        # the meter waits for this answer, write it directly instead of queueing it on the bus
+        CurrentApp().uart.write(transfer.reply(msg) if transfer is not None else msg.replay_get(success=False))
+        return
+    if msg.cmd() in (COSEM.GET_RESP, COSEM.SET_RESP, COSEM.CET_ERROR_RESP):
+        app = CurrentApp()
+        if 'bus' in app.extensions:
+            # meter answered, release the bus for the next request
+            app.bus.complete()
+        if not app.transactions.resolve(msg):
+            logger.warn('no pending transaction for param {}'.format(msg.info().param_id()))
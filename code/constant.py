@@ -238,6 +238,24 @@ class CLASS18_EVENT_FLAG(object):
     EVENT_FLAG_MAX = 20
 
 
+class CLASS18_IMAGE_PARAM_ID(object):
+    """
+        镜像传输0x2200参数id
+
+        InfoEntity.build/image_replay_get原有的处理方式是电表发起GET拉取, 模组以GET_RESP应答.
+        电表协议文档未给出这几个参数的数据格式, 以下格式为约定(假设), 推送(模组SET)和拉取(电表GET的应答)使用同一格式:
+            0x3007 镜像信息: size/4b(大端) block_size/2b(大端) identifier/nb
+            0x3008 镜像块:   block_number/4b(大端) data/nb, 电表GET时参数数据为block_number/4b
+                             GET_RESP参数长度只有1字节, block_size大于251时电表不能拉取镜像块
+            0x3009 校验, 0x300A 激活: 无数据
+        应答为SET_RESP: param_id/2b 0x01 ack/1b
+    """
+    IMAGE_TRANSFER_INITIATE = 0x3007
+    IMAGE_BLOCK_TRANSFER = 0x3008
+    IMAGE_VERIFY = 0x3009
+    IMAGE_ACTIVATE = 0x300A
+
+
 class IMAGE_HEAD_OFFSET(object):
     FIRMWARE_SIGNATURE_OFFSET = 0x00
     FIRMWARE_MCUADDRESS_OFFSET = 0x60
@@ -13,7 +13,10 @@
 # limitations under the License.
 import checkNet
 from usr.qframe import Application
-from usr.business import rfc1662resolver, client, uart
+from usr.constant import TCPMODE
+from usr.business import (
+    rfc1662resolver, transactions, downlink, client, udp_client, server, uart, aggregator, poller, bus
+)
 
 PROJECT_NAME = "QuecPython_Framework_DEMO"
 PROJECT_VERSION = "1.0.0"
@@ -33,7 +36,22 @@ def create_app(name='DTU', config_path='/usr/dev.json'):
 
     rfc1662resolver.init_app(_app)
     uart.init_app(_app)
-    client.init_app(_app)
+    if _app.config.get('RS485_BUS', {}).get('meters'):
+        bus.init_app(_app)
+    transactions.init_app(_app)
+    downlink.init_app(_app)
+    tcp_mode = _app.config.get('TCP_MODE', TCPMODE.CLIENT_MODE)
+    if tcp_mode in (TCPMODE.CLIENT_MODE, TCPMODE.MIX_MODE):
+        if _app.config.get('TRANSPORT', 'tcp') == 'udp':
+            udp_client.init_app(_app)
+        else:
+            client.init_app(_app)
+    if tcp_mode in (TCPMODE.SERVER_MODE, TCPMODE.MIX_MODE):
+        server.init_app(_app)
+    if _app.config.get('UPLINK_BATCH', {}).get('enable', False):
+        aggregator.init_app(_app)
+    if _app.config.get('POLLING', {}).get('enable', False):
+        poller.init_app(_app)
 
     return _app
 
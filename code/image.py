@@ -0,0 +1,466 @@
+# Copyright (c) Quectel Wireless Solution, Co., Ltd.All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uos
+import ql_fs
+import utime
+import uhashlib
+import ubinascii
+import ustruct as struct
+from usr.constant import (
+    COSEM,
+    COSEM_ACK,
+    ALGORITHM_FLAG,
+    IMAGE_HEAD_OFFSET,
+    CLASS18_IMAGE_STATE,
+    CLASS18_IMAGE_PARAM_ID
+)
+from usr.protocol import TransactionError, TransactionTimeout
+from usr.qframe.logging import getLogger
+from usr.qframe.threading import Lock
+
+
+logger = getLogger(__name__)
+
+
+class ImageHeader(object):
+    """
+        电表固件镜像头部, 直接从memoryview按IMAGE_HEAD_OFFSET偏移读取字段(小端)
+
+        签名区0x00~0x60, 按算法取前4(CRC32)/16(MD5)/64(P-256)/96(P-384)字节, 签名覆盖0x60之后的全部数据
+    """
+    SIZE = 0xC0
+    SIGNED_OFFSET = IMAGE_HEAD_OFFSET.FIRMWARE_MCUADDRESS_OFFSET
+    SIGNATURE_LEN = {
+        ALGORITHM_FLAG.FIRMWARE_UPGRADE_CRC32: 4,
+        ALGORITHM_FLAG.FIRMWARE_UPGRADE_MD5: 16,
+        ALGORITHM_FLAG.FIRMWARE_UPGRADE_P256_DIGITAL_SIGNATURE: 64,
+        ALGORITHM_FLAG.FIRMWARE_UPGRADE_P384_DIGITAL_SIGNATURE: 96,
+    }
+
+    def __init__(self, data):
+        view = memoryview(data)
+        if len(view) < self.SIZE:
+            raise ValueError('image header needs {} bytes, got {}.'.format(self.SIZE, len(view)))
+        self.algorithm = view[IMAGE_HEAD_OFFSET.FIRMWARE_ALGORITHM_FLAG_OFFSET]
+        if self.algorithm not in self.SIGNATURE_LEN:
+            raise ValueError('unknown image algorithm flag {}.'.format(self.algorithm))
+        self.signature = bytes(view[:self.SIGNATURE_LEN[self.algorithm]])
+        self.mcu_address = struct.unpack_from("<I", view, IMAGE_HEAD_OFFSET.FIRMWARE_MCUADDRESS_OFFSET)[0]
+        self.size = struct.unpack_from("<I", view, IMAGE_HEAD_OFFSET.FIRMWARE_SIZE_OFFSET)[0]
+        self.manufacturer = self.__text(view, IMAGE_HEAD_OFFSET.FIRMWARE_MANUFACTURER_OFFSET,
+                                        IMAGE_HEAD_OFFSET.FIRMWARE_HARDWARE_TYPE_OFFSET)
+        self.hardware_type = self.__text(view, IMAGE_HEAD_OFFSET.FIRMWARE_HARDWARE_TYPE_OFFSET,
+                                         IMAGE_HEAD_OFFSET.FIRMWARE_SOFTWAREVERSION_OFFSET)
+        self.software_version = self.__text(view, IMAGE_HEAD_OFFSET.FIRMWARE_SOFTWAREVERSION_OFFSET,
+                                            IMAGE_HEAD_OFFSET.FIRMWARE_BUILD_DATE_OFFSET)
+        self.build_date = bytes(view[IMAGE_HEAD_OFFSET.FIRMWARE_BUILD_DATE_OFFSET:
+                                     IMAGE_HEAD_OFFSET.FIRMWARE_ALGORITHM_FLAG_OFFSET])
+        self.image_mode = view[IMAGE_HEAD_OFFSET.FIRMWARE_IMAGE_MODE_BYTE]
+        self.software_type = self.__text(view, IMAGE_HEAD_OFFSET.FIRMWARE_SOFTWARE_TYPE,
+                                         IMAGE_HEAD_OFFSET.FIRMWARE_SOFTWARE_X50)
+        self.software_x50 = bytes(view[IMAGE_HEAD_OFFSET.FIRMWARE_SOFTWARE_X50:self.SIZE])
+
+    @staticmethod
+    def __text(view, start, end):
+        return bytes(view[start:end]).rstrip(b'\0').decode()
+
+    def __str__(self):
+        return '<ImageHeader {},{},{},size={},algorithm={}>'.format(
+            self.manufacturer, self.hardware_type, self.software_version, self.size, self.algorithm
+        )
+
+
+class ImageVerifier(object):
+    """
+        流式镜像校验, 写入每块时更新CRC32/MD5(或签名算法的摘要), 最后一块写完即可得出结果, 无需再次读取flash
+
+        @signature_verifier: P-256/P-384时必须提供, 函数(digest, signature) -> bool
+    """
+
+    def __init__(self, header, signature_verifier=None):
+        self.header = header
+        self.__signature_verifier = signature_verifier
+        self.__skip = ImageHeader.SIGNED_OFFSET
+        self.__crc = 0
+        self.__hash = None
+        self.count = 0
+        if header.algorithm == ALGORITHM_FLAG.FIRMWARE_UPGRADE_MD5:
+            self.__hash = self.__new_hash('md5')
+        elif header.algorithm == ALGORITHM_FLAG.FIRMWARE_UPGRADE_P256_DIGITAL_SIGNATURE:
+            self.__hash = self.__new_hash('sha256')
+        elif header.algorithm == ALGORITHM_FLAG.FIRMWARE_UPGRADE_P384_DIGITAL_SIGNATURE:
+            self.__hash = self.__new_hash('sha384')
+
+    @staticmethod
+    def __new_hash(name):
+        factory = getattr(uhashlib, name, None)
+        if factory is None:
+            raise ValueError('uhashlib has no {} support on this firmware.'.format(name))
+        return factory()
+
+    def update(self, data):
+        """按镜像顺序传入数据块(从镜像起始位置开始)"""
+        self.count += len(data)
+        if self.__skip:
+            skip = min(self.__skip, len(data))
+            self.__skip -= skip
+            data = memoryview(data)[skip:]
+            if not len(data):
+                return
+        if self.__hash is None:
+            self.__crc = ubinascii.crc32(data, self.__crc)
+        else:
+            self.__hash.update(data)
+
+    def finish(self):
+        """@return: True表示校验通过"""
+        signature = self.header.signature
+        if self.header.algorithm == ALGORITHM_FLAG.FIRMWARE_UPGRADE_CRC32:
+            return self.__crc & 0xFFFFFFFF == struct.unpack("<I", signature)[0]
+        digest = self.__hash.digest()
+        if self.header.algorithm == ALGORITHM_FLAG.FIRMWARE_UPGRADE_MD5:
+            return digest == signature
+        if self.__signature_verifier is None:
+            raise ValueError('signature verifier required for algorithm {}.'.format(self.header.algorithm))
+        return self.__signature_verifier(digest, signature)
+
+
+class FileImageSource(object):
+    """
+        flash文件镜像源, 按块随机读取
+    """
+
+    seekable = True
+
+    def __init__(self, path):
+        self.path = path
+        self.size = uos.stat(path)[6]
+        self.__fp = None
+        self.__lock = Lock()
+
+    def read(self, offset, size):
+        # 传输线程与电表拉取应答可能同时读取
+        with self.__lock:
+            if self.__fp is None:
+                self.__fp = open(self.path, 'rb')
+            self.__fp.seek(offset)
+            return self.__fp.read(size)
+
+    def close(self):
+        with self.__lock:
+            if self.__fp is not None:
+                self.__fp.close()
+                self.__fp = None
+
+
+class StreamImageSource(object):
+    """
+        顺序流镜像源(如TCP/HTTP响应), 只能向前读取
+        断点续传时需从头重新打开流, 已传输的块会被跳过
+        @reopen: 可选, 返回一个从头开始的新流, 读取之前的块(重传)时用它重新打开流, 未提供时只能传输一轮
+    """
+
+    def __init__(self, stream, size, reopen=None):
+        self.size = size
+        self.__stream = stream
+        self.__position = 0
+        self.__reopen = reopen
+
+    @property
+    def seekable(self):
+        return self.__reopen is not None
+
+    def read(self, offset, size):
+        if offset < self.__position:
+            if self.__reopen is None:
+                raise ValueError('stream image source cannot seek backwards.')
+            self.close()
+            self.__stream = self.__reopen()
+            self.__position = 0
+        while self.__position < offset:
+            skipped = self.__stream.read(min(offset - self.__position, 512))
+            if not skipped:
+                raise ValueError('image stream ended early.')
+            self.__position += len(skipped)
+        data = b''
+        while len(data) < size:
+            chunk = self.__stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        self.__position += len(data)
+        return data
+
+    def close(self):
+        if hasattr(self.__stream, 'close'):
+            self.__stream.close()
+
+
+class ImageTransfer(object):
+    """
+        class 18镜像传输
+
+        按块从镜像源读取并通过0x2200 SET发送到电表, 最多`window`块在途, 内存中只保留在途的块.
+        已确认的块记录在位图中并持久化到`state_path`, 中断后相同镜像(identifier/size/block_size一致)从断点继续.
+        verify为True时解析镜像头部, 按块顺序边传输边校验, 校验失败则不通知电表校验.
+
+        0x3008的应答不带块号, 流水线发送的块按FIFO匹配应答且超时不重发. 某块超时后它迟到的应答会被算到下一个在途块上,
+        因此出现超时后丢弃在途块的结果(下一轮重传), 等待一个应答超时让迟到的应答落空, 之后逐块发送不再流水线.
+        镜像源的seekable为False(未提供reopen的顺序流)时只传输一轮, 失败后由调用者重新打开流再次运行从断点继续.
+
+        数据格式见CLASS18_IMAGE_PARAM_ID. 传输进行中电表仍可按原有方式GET拉取镜像信息(0x3007)或镜像块(0x3008),
+        由`reply`以同一格式应答, 顺序流镜像源不支持拉取镜像块.
+    """
+    # 正在运行的传输, 用于应答电表拉取
+    active = None
+
+    def __init__(self, transactions, source, identifier, block_size=512, window=4,
+                 state_path='/usr/image_transfer.json', save_every=16, max_passes=3, verify=False,
+                 signature_verifier=None):
+        self.transactions = transactions
+        self.source = source
+        self.identifier = identifier
+        self.block_size = block_size
+        self.window = window
+        self.state_path = state_path
+        self.save_every = save_every
+        self.max_passes = max_passes
+        self.blocks = (source.size + block_size - 1) // block_size
+        self.bitmap = bytearray((self.blocks + 7) // 8)
+        self.state = CLASS18_IMAGE_STATE.IMAGE_TRANSFER_NOT_INITIATED
+        self.__dirty = 0
+        self.verify = verify
+        self.signature_verifier = signature_verifier
+        self.verifier = None
+        self.__verify_next = 0
+        self.__pipelined = True
+
+    def __has_block(self, n):
+        return self.bitmap[n >> 3] & (1 << (n & 7))
+
+    def __set_block(self, n):
+        self.bitmap[n >> 3] |= 1 << (n & 7)
+        self.__dirty += 1
+        if self.__dirty >= self.save_every:
+            self.save_state()
+
+    def progress(self):
+        """@return: (已传输块数, 总块数)"""
+        return sum(1 for n in range(self.blocks) if self.__has_block(n)), self.blocks
+
+    def load_state(self):
+        if not ql_fs.path_exists(self.state_path):
+            return False
+        try:
+            state = ql_fs.read_json(self.state_path)
+            if (state['identifier'] != self.identifier or state['size'] != self.source.size
+                    or state['block_size'] != self.block_size):
+                return False
+            self.bitmap = bytearray(ubinascii.unhexlify(state['bitmap']))
+        except Exception as e:
+            logger.warn("load image transfer state failed: {}".format(e))
+            return False
+        return True
+
+    def save_state(self):
+        ql_fs.touch(self.state_path, {
+            'identifier': self.identifier,
+            'size': self.source.size,
+            'block_size': self.block_size,
+            'bitmap': ubinascii.hexlify(self.bitmap).decode()
+        })
+        self.__dirty = 0
+
+    def clear_state(self):
+        if ql_fs.path_exists(self.state_path):
+            uos.remove(self.state_path)
+
+    @staticmethod
+    def __acked(msg):
+        # SET_RESP: param_id/2b 0x01 ack/1b
+        raw = msg.info_raw()
+        return not raw or len(raw) < 4 or raw[3] == COSEM_ACK.SUCCESS
+
+    def __set(self, param_id, data):
+        try:
+            return self.__acked(self.transactions.set(param_id, data))
+        except TransactionError as e:
+            logger.error("image transfer set {} failed: {}".format(hex(param_id), e))
+            return False
+
+    def __image_info(self):
+        return struct.pack(">IH", self.source.size, self.block_size) + self.identifier.encode()
+
+    def __image_block(self, n):
+        return struct.pack(">I", n) + self.source.read(n * self.block_size, self.block_size)
+
+    def reply(self, msg):
+        """
+        应答电表拉取镜像信息/镜像块的GET请求
+        @return: 应答帧
+        """
+        param_id = msg.info().param_id()
+        try:
+            if param_id == CLASS18_IMAGE_PARAM_ID.IMAGE_TRANSFER_INITIATE:
+                return msg.image_replay_get(self.__image_info())
+            if param_id == CLASS18_IMAGE_PARAM_ID.IMAGE_BLOCK_TRANSFER:
+                n = struct.unpack(">I", msg.info().request_data())[0]
+                # 顺序流不能与传输线程并发读取
+                if n < self.blocks and 4 + self.block_size <= 0xFF and not isinstance(self.source, StreamImageSource):
+                    return msg.image_replay_get(self.__image_block(n))
+        except Exception as e:
+            logger.warn("reply image pull {} failed: {}".format(hex(param_id), e))
+        return msg.replay_get(success=False)
+
+    def initiate(self):
+        data = self.__image_info()
+        if not self.__set(CLASS18_IMAGE_PARAM_ID.IMAGE_TRANSFER_INITIATE, data):
+            return False
+        self.bitmap = bytearray(len(self.bitmap))
+        self.save_state()
+        return True
+
+    def __feed_verifier(self, n, data):
+        if not self.verify or n != self.__verify_next:
+            return
+        if n == 0:
+            try:
+                self.verifier = ImageVerifier(ImageHeader(data), signature_verifier=self.signature_verifier)
+            except ValueError as e:
+                logger.warn("image header not verifiable, skip local verification: {}".format(e))
+                self.verify = False
+                return
+            logger.info("image header: {}".format(self.verifier.header))
+        if self.verifier is not None:
+            self.verifier.update(data)
+            self.__verify_next += 1
+
+    def __local_verify(self):
+        """
+        本地校验, 块不是顺序确认(断点续传/重传)时退回到从镜像源重新读取
+        @return: True通过, False失败, None无法校验
+        """
+        if self.__verify_next != self.blocks:
+            if not isinstance(self.source, FileImageSource):
+                logger.warn("blocks not verified in order, skip local verification.")
+                return None
+            self.__verify_next = 0
+            for n in range(self.blocks):
+                self.__feed_verifier(n, self.source.read(n * self.block_size, self.block_size))
+            self.source.close()
+            if not self.verify:
+                return None
+        try:
+            return self.verifier.finish()
+        except ValueError as e:
+            logger.warn("skip local verification: {}".format(e))
+            return None
+
+    def __resync(self, inflight):
+        """超时后丢弃在途块的结果, 静默一个应答超时, 之后停止流水线"""
+        for _, transaction, _ in inflight:
+            try:
+                transaction.result()
+            except TransactionError:
+                pass
+        del inflight[:]
+        if self.__pipelined:
+            logger.warn("image block timeout, stop pipelining.")
+            self.__pipelined = False
+        utime.sleep(self.transactions.timeout)
+
+    def __collect(self, inflight):
+        n, transaction, data = inflight.pop(0)
+        try:
+            ok = self.__acked(transaction.result())
+        except TransactionTimeout as e:
+            logger.warn("image block {} failed: {}".format(n, e))
+            self.__resync(inflight)
+            return
+        except TransactionError as e:
+            logger.warn("image block {} failed: {}".format(n, e))
+            ok = False
+        if ok:
+            self.__set_block(n)
+            self.__feed_verifier(n, data)
+
+    def __send_blocks(self):
+        inflight = []
+        for n in range(self.blocks):
+            if self.__has_block(n):
+                continue
+            data = self.source.read(n * self.block_size, self.block_size)
+            transaction = self.transactions.request(
+                COSEM.SET,
+                CLASS18_IMAGE_PARAM_ID.IMAGE_BLOCK_TRANSFER,
+                struct.pack(">I", n) + data,
+                pipelined=self.__pipelined
+            )
+            inflight.append((n, transaction, data))
+            if len(inflight) >= (self.window if self.__pipelined else 1):
+                self.__collect(inflight)
+        while inflight:
+            self.__collect(inflight)
+
+    def run(self, activate=False):
+        """
+        执行传输, 校验, 可选激活
+        @return: True表示成功
+        """
+        ImageTransfer.active = self
+        try:
+            return self.__run(activate)
+        finally:
+            ImageTransfer.active = None
+
+    def __run(self, activate):
+        if self.load_state():
+            logger.info("resume image transfer at {}/{} blocks".format(*self.progress()))
+        elif not self.initiate():
+            return False
+        self.state = CLASS18_IMAGE_STATE.IMAGE_TRANSFER_INITIATED
+        self.__pipelined = True
+        passes = self.max_passes if getattr(self.source, 'seekable', False) else 1
+        try:
+            for _ in range(passes):
+                self.__send_blocks()
+                if self.progress()[0] == self.blocks:
+                    break
+        except Exception as e:
+            logger.error("image transfer interrupted: {}".format(e))
+        finally:
+            self.save_state()
+            self.source.close()
+        if self.progress()[0] != self.blocks:
+            return False
+
+        self.state = CLASS18_IMAGE_STATE.IMAGE_VERIFICATION_INITIATED
+        if self.verify and self.__local_verify() is False:
+            logger.error("image local verification failed.")
+            self.state = CLASS18_IMAGE_STATE.IMAGE_VERIFICATION_FAILED
+            self.clear_state()
+            return False
+        if not self.__set(CLASS18_IMAGE_PARAM_ID.IMAGE_VERIFY, b''):
+            self.state = CLASS18_IMAGE_STATE.IMAGE_VERIFICATION_FAILED
+            return False
+        self.state = CLASS18_IMAGE_STATE.IMAGE_VERIFICATION_SUCCESSFUL
+        self.clear_state()
+        if activate:
+            self.state = CLASS18_IMAGE_STATE.IMAGE_ACTIVATION_INITIATED
+            if not self.__set(CLASS18_IMAGE_PARAM_ID.IMAGE_ACTIVATE, b''):
+                self.state = CLASS18_IMAGE_STATE.IMAGE_ACTIVATION_FAILED
+                return False
+            self.state = CLASS18_IMAGE_STATE.IMAGE_ACTIVATION_SUCCESS
+        return True
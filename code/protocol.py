@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import utime
 import ustruct as struct
 from usr.constant import (
     COSEM,
@@ -21,6 +22,7 @@ from usr.constant import (
     CONSEM_COMMON_RFC1662_PARAM_ID
 )
 from usr.qframe.logging import getLogger
+from usr.qframe.threading import Event, Lock, Semaphore, Thread
 
 
 logger = getLogger(__name__)
@@ -245,6 +247,7 @@ class RFC1662Protocol(object):
         self.__csq = 0
         # self.__info_data: InfoEntity = None
         self.__info_data = None
+        self.__info_raw = None
         self.__fcs = None
         self.__replay_data = ""
 
@@ -266,6 +269,13 @@ class RFC1662Protocol(object):
     def set_info_cmd(self, info_cmd):
         self.__info_cmd = info_cmd
 
+    def set_info_raw(self, info_raw):
+        self.__info_raw = info_raw
+
+    def info_raw(self):
+        """info区命令字之后的原始数据"""
+        return self.__info_raw
+
     def set_protocol(self, param):
         self.__protocol = param
 
@@ -301,6 +311,7 @@ class RFC1662Protocol(object):
             info_data_len = info_len - 1
             info_data = struct.unpack("{}s".format(info_data_len),
                                       data[rfc_proto.position():rfc_proto.position() + info_data_len])[0]
+            rfc_proto.set_info_raw(info_data)
             rfc_proto.set_info_data(InfoEntity.build(info_data, info_cmd, info_data_len))
             rfc_proto.increment(info_data_len)
 
@@ -382,6 +393,39 @@ class RFC1662Protocol(object):
         rfc_proto._replay_data = replay_data[:-3] + struct.pack("<HB", rfc_proto._fcs, rfc_proto.END)
         return rfc_proto._replay_data
 
+    @classmethod
+    def build_rfc_0x2200_batch(cls, mode, items):
+        """
+        RFC 2200 批量数据帧组包, 需电表固件支持一帧多参数
+        items = [(parame_id, data), ...] // get时data为None
+        GET info: cmd + parame_id/2b * n
+        SET info: cmd + (parame_id/2b + len/1b + data) * n
+        """
+        info = struct.pack("<B", mode)
+        for parame_id, data in items:
+            info += struct.pack("<H", parame_id)
+            if mode != COSEM.GET:
+                info += struct.pack("<B", len(data)) + data
+        replay_data = struct.pack("<BBB", cls.HEADER, cls.ADDRESS, cls.CONTROL) + struct.pack("<H", 0x2200) + \
+                      struct.pack(">H", len(info)) + info + struct.pack("<HB", 0x0000, cls.END)
+        fcs = FCSUtil.calc_crc(replay_data)
+        return replay_data[:-3] + struct.pack("<HB", fcs, cls.END)
+
+    @staticmethod
+    def parse_batch_items(info_raw):
+        """
+        解析批量应答info数据: (parame_id/2b + len/1b + data) * n
+        @return: [(parame_id, data), ...]
+        """
+        items = []
+        offset = 0
+        while offset + 3 <= len(info_raw):
+            parame_id = struct.unpack("<H", info_raw[offset:offset + 2])[0]
+            length = info_raw[offset + 2]
+            items.append((parame_id, info_raw[offset + 3:offset + 3 + length]))
+            offset += 3 + length
+        return items
+
     def pack_replay_data(self, info_data):
         self.__info_len = len(info_data) + 1
         self.__csq = 0
@@ -480,6 +524,153 @@ class RFC1662Protocol(object):
         return " ".join(["%02x" % x for x in self.__replay_data])
 
 
+class WrapperReassembler(object):
+    """
+        按IEC 62056-47 wrapper头部从TCP字节流中重组DLMS应用层PDU
+
+        wrapper头部8字节(大端): version/2b(0x0001) source_wport/2b destination_wport/2b length/2b
+    """
+    VERSION = 0x0001
+    HEADER_SIZE = 8
+
+    def __init__(self, max_info_len=1024, max_pdu_len=2048, timeout=1000):
+        """
+        @max_info_len: 电表支持的最大info长度(含1字节命令)
+        @max_pdu_len: 允许的最大APDU长度, 超过则丢弃缓存
+        @timeout: 不完整PDU的最长等待时间(ms)
+        """
+        if max_info_len < 2:
+            raise ValueError('max_info_len must be greater than 1.')
+        self.__max_info_len = max_info_len
+        self.__max_pdu_len = max_pdu_len
+        self.__timeout = timeout
+        self.__buffer = bytearray()
+        self.__last_feed = None
+        self.__lock = Lock()
+
+    def clear(self):
+        self.__buffer = bytearray()
+
+    def __expire(self, now):
+        if self.__buffer and utime.ticks_diff(now, self.__last_feed) > self.__timeout:
+            logger.warn("drop incomplete pdu {}".format(bytes(self.__buffer)))
+            self.clear()
+            return True
+        return False
+
+    def expire(self):
+        """
+        丢弃超时的不完整PDU, 需定时调用, 使超时按时生效而不是等到下一段数据到达
+        @return: True表示有数据被丢弃
+        """
+        with self.__lock:
+            return self.__expire(utime.ticks_ms())
+
+    def feed(self, data):
+        """
+        追加TCP数据, 返回已完整的PDU列表(含wrapper头部)
+        非wrapper格式的数据原样透传
+        """
+        with self.__lock:
+            return self.__feed(data)
+
+    def __feed(self, data):
+        now = utime.ticks_ms()
+        self.__expire(now)
+        self.__last_feed = now
+        self.__buffer.extend(data)
+        pdus = []
+        while len(self.__buffer) >= 2:
+            if struct.unpack_from(">H", self.__buffer)[0] != self.VERSION:
+                # 不是wrapper数据, 透传
+                pdus.append(bytes(self.__buffer))
+                self.clear()
+                break
+            if len(self.__buffer) < self.HEADER_SIZE:
+                break
+            length = struct.unpack_from(">H", self.__buffer, 6)[0]
+            if length > self.__max_pdu_len:
+                logger.error("wrapper pdu length {} exceeds {}, drop".format(length, self.__max_pdu_len))
+                self.clear()
+                break
+            total = self.HEADER_SIZE + length
+            if len(self.__buffer) < total:
+                break
+            pdus.append(bytes(self.__buffer[:total]))
+            self.__buffer = self.__buffer[total:]
+        return pdus
+
+    def split(self, pdu):
+        """按电表最大info长度切分PDU, 每段对应一个0x2100帧"""
+        chunk = self.__max_info_len - 1
+        if len(pdu) <= chunk:
+            return [pdu]
+        view = memoryview(pdu)
+        return [view[i:i + chunk] for i in range(0, len(pdu), chunk)]
+
+
+class DownlinkReassembly(object):
+    """
+        下行wrapper PDU重组
+
+        为每个下行数据源(云端客户端, 服务端会话)创建WrapperReassembler, 定时线程按时丢弃超时的不完整PDU,
+        不用等到下一段数据到达.
+    """
+
+    def __init__(self, app=None):
+        self.__config = {}
+        self.__interval = 250
+        self.__reassemblers = []
+        self.__lock = Lock()
+        self.__expire_thread = Thread(target=self.expire_thread_worker)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.__config = dict(app.config.get('DOWNLINK', {}))
+        self.__interval = max(50, self.__config.get('timeout', 1000) // 4)
+        app.extensions['downlink'] = self
+
+    def load(self):
+        self.__expire_thread.start()
+
+    def new(self):
+        reassembler = WrapperReassembler(**self.__config)
+        with self.__lock:
+            self.__reassemblers.append(reassembler)
+        return reassembler
+
+    def release(self, reassembler):
+        with self.__lock:
+            if reassembler in self.__reassemblers:
+                self.__reassemblers.remove(reassembler)
+
+    def expire_thread_worker(self):
+        while True:
+            utime.sleep_ms(self.__interval)
+            with self.__lock:
+                reassemblers = list(self.__reassemblers)
+            for reassembler in reassemblers:
+                reassembler.expire()
+
+
+def dlms_destination(pdu):
+    """
+    HES下行PDU的目的电表地址
+    wrapper PDU取destination wPort, HDLC帧(0x7E, 帧类型0xA)取目的地址, 无法识别返回None
+    """
+    if len(pdu) >= WrapperReassembler.HEADER_SIZE and struct.unpack(">H", pdu[:2])[0] == WrapperReassembler.VERSION:
+        return struct.unpack(">H", pdu[4:6])[0]
+    if len(pdu) >= 4 and pdu[0] == 0x7E and (pdu[1] & 0xF0) == 0xA0:
+        # HDLC地址1/2/4字节, 每字节高7位为地址, 最低位为1表示最后一个字节
+        address = 0
+        for i in range(3, min(len(pdu), 7)):
+            address = (address << 7) | (pdu[i] >> 1)
+            if pdu[i] & 0x01:
+                return address
+    return None
+
+
 class RFC1662ProtocolResolver(object):
     support_protocol_handlers = {}
 
@@ -518,3 +709,332 @@ class RFC1662ProtocolResolver(object):
         # module send data, 2200 packet
         # data: [get/set, id, data]
         return RFC1662Protocol.build_rfc_0x2200(data)
+
+
+class TransactionError(Exception):
+    pass
+
+
+class TransactionTimeout(TransactionError):
+    pass
+
+
+class Transaction(object):
+    """模组到电表的一次0x2200请求, 作为future使用"""
+
+    def __init__(self, mode, param_id, frame, deadline, batch=None, pipelined=False):
+        self.mode = mode
+        self.param_id = param_id
+        self.frame = frame
+        self.deadline = deadline
+        self.batch = batch
+        self.pipelined = pipelined
+        self.retries = 0
+        self.__finished = Event()
+        self.__msg = None
+        self.__exc = None
+
+    def __str__(self):
+        return '<Transaction {},{}>'.format(hex(self.mode), hex(self.param_id))
+
+    def set_result(self, msg):
+        self.__msg = msg
+        self.__finished.set()
+
+    def set_exception(self, exc):
+        self.__exc = exc
+        self.__finished.set()
+
+    def done(self):
+        return self.__finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        等待电表应答
+        @return: 电表应答的RFC1662Protocol对象
+        """
+        if not self.__finished.wait(timeout=timeout):
+            raise TransactionTimeout('wait {} timeout.'.format(self))
+        if self.__exc:
+            raise self.__exc
+        return self.__msg
+
+
+class ParamCache(object):
+    """
+        电表参数缓存, 由GET_RESP填充, SET时失效
+
+        每个param_id可配置独立的ttl(s), ttl为0表示不缓存.
+    """
+
+    def __init__(self, default_ttl=0, ttl=None):
+        self.__default_ttl = default_ttl
+        self.__ttl = {}
+        self.__entries = {}
+        self.__lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        for param_id, value in (ttl or {}).items():
+            self.set_ttl(param_id, value)
+
+    def set_ttl(self, param_id, ttl):
+        if isinstance(param_id, str):
+            param_id = int(param_id, 16)
+        self.__ttl[param_id] = ttl
+
+    def ttl(self, param_id):
+        return self.__ttl.get(param_id, self.__default_ttl)
+
+    def put(self, param_id, value):
+        ttl = self.ttl(param_id)
+        if not ttl or value is None:
+            return
+        with self.__lock:
+            self.__entries[param_id] = (value, utime.ticks_add(utime.ticks_ms(), ttl * 1000))
+
+    def get(self, param_id):
+        """@return: 缓存值, 未命中或已过期返回None"""
+        with self.__lock:
+            entry = self.__entries.get(param_id)
+            if entry is not None:
+                if utime.ticks_diff(entry[1], utime.ticks_ms()) > 0:
+                    self.hits += 1
+                    return entry[0]
+                del self.__entries[param_id]
+            self.misses += 1
+            return None
+
+    def invalidate(self, param_id=None):
+        with self.__lock:
+            if param_id is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(param_id, None)
+
+
+class TransactionManager(object):
+    """
+        模组到电表0x2200请求的事务管理
+
+        以param_id为键维护待应答请求表, 超时重发, 同一时间最多`window`个请求在途.
+        相同param_id的GET请求复用同一个事务. GET_RESP的数据写入参数缓存, `read`命中缓存时不访问电表.
+        pipelined请求允许同一param_id多个在途, 按发送顺序(FIFO)匹配应答, 超时不重发.
+    """
+
+    def __init__(self, app=None, window=4, timeout=3, retries=2, batch_supported=False):
+        self.__app = None
+        self.__batch_supported = batch_supported
+        self.__window = window
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__slots = Semaphore(window)
+        self.__pending = {}
+        self.__lock = Lock()
+        self.__timeout_thread = Thread(target=self.timeout_thread_worker)
+        self.__warmup = []
+        self.cache = ParamCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get('TRANSACTION', {})
+        self.__window = config.get('window', self.__window)
+        self.__timeout = config.get('timeout', self.__timeout)
+        self.__retries = config.get('retries', self.__retries)
+        self.__batch_supported = config.get('batch', self.__batch_supported)
+        self.__slots = Semaphore(self.__window)
+        cache_config = app.config.get('PARAM_CACHE', {})
+        self.cache = ParamCache(cache_config.get('default_ttl', 0), cache_config.get('ttl'))
+        self.__warmup = [int(param_id, 16) for param_id in cache_config.get('warmup', [])]
+        self.__app = app
+        app.extensions['transactions'] = self
+
+    def load(self):
+        if self.__warmup:
+            Thread(target=self.warm_up, args=(self.__warmup, )).start()
+
+    def warm_up(self, param_ids):
+        """启动时预读参数到缓存"""
+        for param_id in param_ids:
+            try:
+                self.read(param_id)
+            except Exception as e:
+                logger.warn("warm up param {} failed: {}".format(hex(param_id), e))
+
+    @property
+    def timeout(self):
+        """单次请求等待应答的时间(s)"""
+        return self.__timeout
+
+    def __deadline(self):
+        return utime.ticks_add(utime.ticks_ms(), self.__timeout * 1000)
+
+    def __write(self, frame):
+        # 多电表共享总线时经总线调度发送, 0x2200帧不带地址, 发往默认电表
+        try:
+            if 'bus' in self.__app.extensions:
+                if not self.__app.bus.submit(None, [frame]):
+                    logger.warn("bus dropped transaction frame.")
+            else:
+                self.__app.uart.write(frame)
+        except Exception as e:
+            logger.error("transaction write error: {}".format(e))
+
+    def __submit(self, mode, param_id, frame, batch=None, pipelined=False):
+        with self.__lock:
+            queue = self.__pending.get(param_id)
+            if queue:
+                first = queue[0]
+                if (mode == COSEM.GET and first.mode == COSEM.GET and batch is None and first.batch is None
+                        and not pipelined and not first.pipelined):
+                    return first
+                if not (pipelined and first.pipelined):
+                    raise TransactionError('param {} already has a pending request.'.format(hex(param_id)))
+        if mode == COSEM.SET:
+            for item in batch or (param_id, ):
+                self.cache.invalidate(item)
+        if not self.__slots.acquire(timeout=self.__timeout * (self.__retries + 1)):
+            raise TransactionTimeout('no free transaction slot.')
+        transaction = Transaction(mode, param_id, frame, self.__deadline(), batch=batch, pipelined=pipelined)
+        with self.__lock:
+            self.__pending.setdefault(param_id, []).append(transaction)
+        self.__timeout_thread.start()
+        self.__write(frame)
+        return transaction
+
+    def request(self, mode, param_id, data=None, pipelined=False):
+        """
+        发起请求, 不等待应答
+        @mode: COSEM.GET 或 COSEM.SET
+        @pipelined: 同一param_id可多个在途, 应答按FIFO匹配
+        @return: Transaction
+        """
+        frame = RFC1662Protocol.build_rfc_0x2200([mode, param_id, data])
+        return self.__submit(mode, param_id, frame, pipelined=pipelined)
+
+    def get(self, param_id, timeout=None):
+        return self.request(COSEM.GET, param_id).result(timeout=timeout)
+
+    def set(self, param_id, data, timeout=None):
+        return self.request(COSEM.SET, param_id, data).result(timeout=timeout)
+
+    def read(self, param_id, timeout=None):
+        """
+        读取参数值, 优先使用缓存
+        @return: GET_RESP中的参数数据
+        """
+        value = self.cache.get(param_id)
+        if value is None:
+            value = self.get(param_id, timeout=timeout).info().request_data()
+        return value
+
+    def batch(self, mode, items, timeout=None):
+        """
+        批量GET/SET
+        电表固件支持时(TRANSACTION.batch)打包为一帧, 否则在窗口内流水线发送.
+        @items: [(param_id, data), ...], GET时data为None
+        @return: {param_id: (status, data)}, status为COSEM_ACK值, GET成功时data为参数数据
+        """
+        results = {}
+        if mode == COSEM.GET:
+            for param_id, _ in items:
+                value = self.cache.get(param_id)
+                if value is not None:
+                    results[param_id] = (COSEM_ACK.SUCCESS, value)
+            items = [item for item in items if item[0] not in results]
+        if not items:
+            return results
+        if self.__batch_supported and len(items) > 1:
+            frame = RFC1662Protocol.build_rfc_0x2200_batch(mode, items)
+            transaction = self.__submit(mode, items[0][0], frame, batch=[item[0] for item in items])
+            try:
+                results.update(transaction.result(timeout=timeout))
+            except TransactionError as e:
+                logger.warn("batch {} failed: {}".format(transaction, e))
+                for param_id, _ in items:
+                    results[param_id] = (COSEM_ACK.FAILED, None)
+            return results
+        transactions = [(item[0], self.request(mode, item[0], item[1])) for item in items]
+        for param_id, transaction in transactions:
+            try:
+                msg = transaction.result(timeout=timeout)
+            except TransactionError:
+                results[param_id] = (COSEM_ACK.FAILED, None)
+                continue
+            if mode == COSEM.GET:
+                results[param_id] = (COSEM_ACK.SUCCESS, msg.info().request_data())
+            else:
+                raw = msg.info_raw()
+                results[param_id] = (raw[3] if raw and len(raw) > 3 else COSEM_ACK.SUCCESS, None)
+        return results
+
+    def batch_get(self, param_ids, timeout=None):
+        return self.batch(COSEM.GET, [(param_id, None) for param_id in param_ids], timeout=timeout)
+
+    def batch_set(self, items, timeout=None):
+        """@items: {param_id: data}"""
+        return self.batch(COSEM.SET, list(items.items()), timeout=timeout)
+
+    def __batch_results(self, transaction, msg):
+        results = {}
+        for param_id, data in RFC1662Protocol.parse_batch_items(msg.info_raw() or b''):
+            if msg.cmd() == COSEM.GET_RESP:
+                results[param_id] = (COSEM_ACK.SUCCESS, data)
+                self.cache.put(param_id, data)
+            else:
+                # SET_RESP/CET_ERROR_RESP 每项数据为1字节应答码
+                results[param_id] = (data[0] if data else COSEM_ACK.FAILED, None)
+        for param_id in transaction.batch:
+            results.setdefault(param_id, (COSEM_ACK.FAILED, None))
+        return results
+
+    def __finish(self, param_id, transaction=None):
+        """从待应答表移除事务, 未指定时取该param_id最早的一个"""
+        with self.__lock:
+            queue = self.__pending.get(param_id)
+            if not queue:
+                return None
+            if transaction is None:
+                transaction = queue.pop(0)
+            elif transaction in queue:
+                queue.remove(transaction)
+            else:
+                return None
+            if not queue:
+                del self.__pending[param_id]
+        self.__slots.release()
+        return transaction
+
+    def resolve(self, msg):
+        """
+        处理电表应答, 完成对应的事务
+        @return: True表示应答匹配到了待应答请求
+        """
+        transaction = self.__finish(msg.info().param_id())
+        if transaction is None:
+            return False
+        if transaction.batch is not None:
+            transaction.set_result(self.__batch_results(transaction, msg))
+        elif msg.cmd() == COSEM.CET_ERROR_RESP:
+            transaction.set_exception(TransactionError('{} error response.'.format(transaction)))
+        else:
+            if msg.cmd() == COSEM.GET_RESP:
+                self.cache.put(transaction.param_id, msg.info().request_data())
+            transaction.set_result(msg)
+        return True
+
+    def timeout_thread_worker(self):
+        while True:
+            utime.sleep_ms(100)
+            now = utime.ticks_ms()
+            with self.__lock:
+                expired = [t for queue in self.__pending.values() for t in queue
+                           if utime.ticks_diff(t.deadline, now) <= 0]
+            for transaction in expired:
+                if transaction.retries < self.__retries and not transaction.pipelined:
+                    transaction.retries += 1
+                    transaction.deadline = self.__deadline()
+                    logger.warn("{} timeout, retry {}".format(transaction, transaction.retries))
+                    self.__write(transaction.frame)
+                elif self.__finish(transaction.param_id, transaction) is transaction:
+                    transaction.set_exception(TransactionTimeout('{} timeout.'.format(transaction)))
@@ -1,4 +1,4 @@
 """Programing Framework for QuecPython Platform"""
 
 from .core import Application, CurrentApp, G, AppExtensionABC
-from .builtins import TcpClient, Uart
+from .builtins import TcpClient, UdpClient, TcpServer, Uart, Aggregator, Poller, MeterBus
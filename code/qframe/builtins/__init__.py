@@ -1,5 +1,9 @@
 """QuecPython builtin Extensions"""
 
-from .clients import TcpClient, SmsClient
+from .clients import TcpClient, UdpClient, SmsClient, ReconnectPolicy, Endpoint, EndpointPool, AsyncSender
+from .servers import TcpServer, Session
+from .aggregator import Aggregator
+from .bus import MeterBus, BusSession
+from .poller import Poller, Schedule, CronExpr
 from .uart import Uart
 from .network import network
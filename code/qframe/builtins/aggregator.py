@@ -0,0 +1,132 @@
+import utime
+import uzlib
+import ustruct as struct
+from .. import AppExtensionABC
+from ..threading import Condition, Thread
+from ..logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Aggregator(AppExtensionABC):
+    """collect small uplink payloads into one batch envelope.
+
+    a batch is emitted through `flush_callback` when its first payload is `max_delay` ms old or it reaches
+    `max_bytes`, a payload that would push the pending batch over `max_bytes` flushes that batch first.
+    envelope: version(1B) flags(1B) count(2B) body, body is count * (len(2B) payload), zlib
+    compressed when flags has FLAG_COMPRESSED. compression is only used for bodies of at least
+    `compress_threshold` bytes and only if the firmware `uzlib` can compress.
+    """
+    VERSION = 0x01
+    FLAG_COMPRESSED = 0x01
+    HEADER = '>BBH'
+    HEADER_SIZE = 4
+
+    def __init__(self, name, app=None):
+        self.__max_delay = 200
+        self.__max_bytes = 1024
+        self.__compress = None
+        self.__compress_threshold = None
+        self.__records = []
+        self.__size = 0
+        self.__first = None
+        self.__cond = Condition()
+        self.__flush_thread = Thread(target=self.flush_thread_worker)
+        super().__init__(name, app=app)
+
+    def init_app(self, app):
+        config = app.config.get('UPLINK_BATCH', {})
+        self.__max_delay = config.get('max_delay', self.__max_delay)
+        self.__max_bytes = config.get('max_bytes', self.__max_bytes)
+        self.__compress_threshold = config.get('compress_threshold')
+        if self.__compress_threshold is not None:
+            self.__compress = getattr(uzlib, 'compress', None)
+            if self.__compress is None:
+                logger.warn('uzlib has no compress support on this firmware, batches are sent uncompressed.')
+        app.append_extension(self)
+
+    def load(self):
+        self.__flush_thread.start()
+
+    def flush_callback(self, batch):
+        raise NotImplementedError('you must implement this method to send a batch.')
+
+    def put(self, data):
+        batches = []
+        with self.__cond:
+            if self.__records and self.__size + 2 + len(data) > self.__max_bytes:
+                # the record does not fit into the pending batch, flush that first
+                batches.append(self.__take())
+            self.__records.append(bytes(data))
+            self.__size += 2 + len(data)
+            if self.__first is None:
+                self.__first = utime.ticks_ms()
+                self.__cond.notify()
+            if self.__size >= self.__max_bytes:
+                batches.append(self.__take())
+        for batch in batches:
+            self.__emit(batch)
+
+    def flush(self):
+        with self.__cond:
+            batch = self.__take()
+        if batch is not None:
+            self.__emit(batch)
+
+    def __take(self):
+        if not self.__records:
+            return None
+        records = self.__records
+        self.__records = []
+        self.__size = 0
+        self.__first = None
+        return self.pack(records, self.__compress if self.__compress_threshold is not None else None,
+                         self.__compress_threshold or 0)
+
+    def __emit(self, batch):
+        try:
+            self.flush_callback(batch)
+        except Exception as e:
+            logger.error('flush_callback error: {}'.format(e))
+
+    def flush_thread_worker(self):
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__first is not None)
+                first = self.__first
+            remaining = self.__max_delay - utime.ticks_diff(utime.ticks_ms(), first)
+            if remaining > 0:
+                utime.sleep_ms(remaining)
+            with self.__cond:
+                # skip if the batch was already flushed by size meanwhile
+                batch = self.__take() if self.__first == first else None
+            if batch is not None:
+                self.__emit(batch)
+
+    @classmethod
+    def pack(cls, records, compress=None, compress_threshold=0):
+        body = b''.join(struct.pack('>H', len(record)) + record for record in records)
+        flags = 0
+        if compress is not None and len(body) >= compress_threshold:
+            compressed = compress(body)
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= cls.FLAG_COMPRESSED
+        return struct.pack(cls.HEADER, cls.VERSION, flags, len(records)) + body
+
+    @classmethod
+    def unpack(cls, batch):
+        version, flags, count = struct.unpack(cls.HEADER, batch[:cls.HEADER_SIZE])
+        if version != cls.VERSION:
+            raise ValueError('unsupported batch version {}'.format(version))
+        body = batch[cls.HEADER_SIZE:]
+        if flags & cls.FLAG_COMPRESSED:
+            body = uzlib.decompress(body)
+        records = []
+        offset = 0
+        for _ in range(count):
+            size = struct.unpack('>H', body[offset:offset + 2])[0]
+            records.append(body[offset + 2:offset + 2 + size])
+            offset += 2 + size
+        return records
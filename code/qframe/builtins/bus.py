@@ -0,0 +1,144 @@
+import utime
+from .. import AppExtensionABC
+from ..collections import OrderedDict
+from ..threading import Condition, Queue, Thread
+from ..logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class BusSession(object):
+    """requests queued for one device address on a shared half-duplex bus."""
+
+    def __init__(self, address, max_queue=16):
+        self.address = address
+        self.queue = Queue(max_size=max_queue)
+        self.credit = 0
+        self.stats = {'requests': 0, 'responses': 0, 'timeouts': 0, 'dropped': 0, 'bus_time_ms': 0}
+
+    def __str__(self):
+        return '<BusSession {}>'.format(self.address)
+
+
+class MeterBus(AppExtensionABC):
+    """share one serial bus between several meters.
+
+    every meter address has its own queue. a deficit round robin scheduler gives each backlogged meter
+    `quantum` ms of bus time per round, a request holds the bus until `complete` is called for its response or
+    `turnaround` seconds elapse. a slow meter therefore only delays its own queue.
+    """
+
+    def __init__(self, name, app=None):
+        self.__sessions = OrderedDict()
+        self.__default_address = None
+        self.__max_meters = 8
+        self.__max_queue = 16
+        self.__quantum = 500
+        self.__turnaround = 2
+        self.__current = None
+        self.__cond = Condition()
+        self.__bus_thread = Thread(target=self.bus_thread_worker)
+        super().__init__(name, app=app)
+
+    def init_app(self, app):
+        config = app.config.get('RS485_BUS', {})
+        self.__max_meters = config.get('max_meters', self.__max_meters)
+        self.__max_queue = config.get('max_queue', self.__max_queue)
+        self.__quantum = config.get('quantum', self.__quantum)
+        self.__turnaround = config.get('turnaround', self.__turnaround)
+        for address in config.get('meters', []):
+            self.session(int(address, 16))
+        if self.__sessions.map:
+            self.__default_address = next(iter(self.__sessions))
+        app.append_extension(self)
+
+    def load(self):
+        self.__bus_thread.start()
+
+    def write_callback(self, address, data):
+        raise NotImplementedError('you must implement this method to write data to the bus.')
+
+    def stats(self):
+        return {address: dict(session.stats) for address, session in self.__sessions.items()}
+
+    def session(self, address):
+        """get or create the session of `address`.
+
+        a new address gets its own session until `max_meters` sessions exist, after that and for a None address
+        (e.g. module requests, which carry no meter address) the default meter's session is returned. the default
+        meter is the first configured one, or the first address seen if none is configured.
+        """
+        with self.__cond:
+            session = self.__sessions.map.get(address)
+            if session is None:
+                if address is None or len(self.__sessions.map) >= self.__max_meters:
+                    return self.__sessions.map.get(self.__default_address)
+                session = BusSession(address, max_queue=self.__max_queue)
+                self.__sessions[address] = session
+                if self.__default_address is None:
+                    self.__default_address = address
+            return session
+
+    def submit(self, address, data):
+        """queue `data` for the meter at `address`, return False if it was dropped."""
+        session = self.session(address)
+        if session is None:
+            logger.warn('no bus session for address {}'.format(address))
+            return False
+        try:
+            session.queue.put(data, block=False)
+        except Queue.Full:
+            session.stats['dropped'] += 1
+            logger.warn('{} queue full, drop request.'.format(session))
+            return False
+        with self.__cond:
+            self.__cond.notify()
+        return True
+
+    def complete(self):
+        """called when a response arrives on the bus, releases it for the next request."""
+        with self.__cond:
+            if self.__current is not None:
+                self.__current.stats['responses'] += 1
+                self.__current = None
+                self.__cond.notify_all()
+
+    def __has_work(self):
+        return any(session.queue.size() for session in self.__sessions.values())
+
+    def __transact(self, session, data):
+        start = utime.ticks_ms()
+        with self.__cond:
+            self.__current = session
+        session.stats['requests'] += 1
+        try:
+            self.write_callback(session.address, data)
+        except Exception as e:
+            logger.error('{} write error: {}'.format(session, e))
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__current is not session, timeout=self.__turnaround):
+                session.stats['timeouts'] += 1
+                self.__current = None
+        cost = utime.ticks_diff(utime.ticks_ms(), start)
+        session.stats['bus_time_ms'] += cost
+        return cost
+
+    def bus_thread_worker(self):
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(self.__has_work)
+            with self.__cond:
+                sessions = list(self.__sessions.values())
+            for session in sessions:
+                if not session.queue.size():
+                    session.credit = 0
+                    continue
+                session.credit += self.__quantum
+                while session.credit > 0:
+                    try:
+                        data = session.queue.get(block=False)
+                    except Queue.Empty:
+                        session.credit = 0
+                        break
+                    session.credit -= self.__transact(session, data)
@@ -1,102 +1,782 @@
 import sms
+import utime
+import urandom
+import ustruct as struct
 from .. import AppExtensionABC
-from ..threading import Condition, Thread, Queue
-from ..datetime import DateTime, TimeDelta
-from ..qsocket import TcpSocket
+from ..threading import Condition, Lock, Thread, Queue
+from ..qsocket import TcpSocket, UdpSocket
+from ..journal import Journal
 from ..logging import getLogger
 
 
 logger = getLogger(__name__)
 
 
+class ReconnectPolicy(object):
+    """exponential backoff with full jitter plus a circuit breaker for client reconnects.
+
+    the n-th retry waits a random time in [0, min(max_delay, base_delay * multiplier ** n)] seconds, so a fleet
+    recovering from the same outage does not reconnect in lockstep.
+    """
+    CLOSED = 0  # link is up, sending allowed
+    OPEN = 1  # link is down, sending rejected immediately
+    HALF_OPEN = 2  # reconnect attempt in progress
+
+    def __init__(self, base_delay=1, max_delay=300, multiplier=2):
+        if base_delay <= 0 or max_delay < base_delay or multiplier < 1:
+            raise ValueError('invalid reconnect policy parameters.')
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.state = self.OPEN
+        self.__attempts = 0
+
+    def __str__(self):
+        return '<ReconnectPolicy state={},attempts={}>'.format(self.state, self.__attempts)
+
+    @property
+    def attempts(self):
+        return self.__attempts
+
+    def allow(self):
+        """cheap check used on the send path, no locking."""
+        return self.state == self.CLOSED
+
+    def next_delay(self):
+        """return next backoff delay(s) and move to half-open state."""
+        cap = min(self.max_delay, self.base_delay * self.multiplier ** self.__attempts)
+        if cap < self.max_delay:
+            self.__attempts += 1
+        self.state = self.HALF_OPEN
+        return urandom.random() * cap
+
+    def success(self):
+        self.__attempts = 0
+        self.state = self.CLOSED
+
+    def failure(self):
+        self.state = self.OPEN
+
+
+class Endpoint(object):
+    """one head-end server, with its rank inputs: priority(lower first), weight and measured connect latency."""
+
+    def __init__(self, host, port, timeout=None, keep_alive=None, priority=0, weight=1):
+        if weight <= 0:
+            raise ValueError('endpoint weight must be greater than 0.')
+        self.sock = TcpSocket(host, port, timeout=timeout, keep_alive=keep_alive)
+        self.priority = priority
+        self.weight = weight
+        self.latency = None  # smoothed connect latency(ms)
+        self.failures = 0
+
+    def __str__(self):
+        return str(self.sock)
+
+    def score(self):
+        latency = self.latency if self.latency is not None else 0
+        return self.failures > 0, self.priority, latency / self.weight
+
+    def connect(self):
+        start = utime.ticks_ms()
+        try:
+            self.sock.connect()
+        except Exception as e:
+            self.failures += 1
+            self.sock.disconnect()
+            raise e
+        cost = utime.ticks_diff(utime.ticks_ms(), start)
+        self.latency = cost if self.latency is None else (self.latency * 7 + cost) // 8
+        self.failures = 0
+
+    def probe(self):
+        """health probe, measure connect latency and close."""
+        try:
+            self.connect()
+        except Exception as e:
+            logger.warn('{} probe failed: {}'.format(self, e))
+            return False
+        self.sock.disconnect()
+        return True
+
+    def is_alive(self):
+        # 4 is the established state of `getsocketsta`
+        try:
+            return self.sock.status_code == 4
+        except Exception:
+            return False
+
+
+class EndpointPool(object):
+    """endpoints of one client, `lock` serializes every connect/disconnect of their sockets (connect, failover,
+    standby preparation and probes), so a probe never closes a socket another thread just made active.
+    """
+
+    def __init__(self, endpoints):
+        if not endpoints:
+            raise ValueError('at least one endpoint required.')
+        self.endpoints = endpoints
+        self.lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """`config` is one endpoint dict or a list of endpoint dicts."""
+        if isinstance(config, dict):
+            config = [config]
+        return cls([Endpoint(**item) for item in config])
+
+    def ranked(self, exclude=()):
+        return sorted((ep for ep in self.endpoints if ep not in exclude), key=lambda ep: ep.score())
+
+
+class AsyncSender(object):
+    """bounded outbound queue drained by a dedicated writer thread.
+
+    @send: blocking send function, called by the writer thread only.
+    @ready: optional predicate, the writer waits while it is False (e.g. link down) instead of failing messages.
+    @max_size: queue capacity.
+    @overflow: "drop_oldest" or "drop_newest", what to discard when the queue is full.
+    @deadline: default message lifetime(s), stale messages are dropped before sending. None means no deadline.
+    @journal: optional `Journal`, messages that cannot be sent are stored there and replayed once `ready`.
+    @replay_rate: max journal records replayed per second, None for no limit.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+    def __init__(self, send, ready=None, max_size=64, overflow=DROP_OLDEST, deadline=None, journal=None,
+                 replay_rate=None):
+        if overflow not in (self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError('unknown overflow policy \"{}\".'.format(overflow))
+        self.__send = send
+        self.__ready = ready
+        self.__overflow = overflow
+        self.__deadline = deadline
+        self.__journal = journal
+        self.__replay_rate = replay_rate
+        self.__queue = Queue(max_size=max_size)
+        self.__writer_thread = Thread(target=self.writer_thread_worker)
+        self.__stats = {'queued': 0, 'sent': 0, 'failed': 0, 'overflow': 0, 'stale': 0, 'journaled': 0}
+
+    @classmethod
+    def from_config(cls, app, send, ready=None):
+        """build from SEND_QUEUE and the optional JOURNAL settings."""
+        journal_config = dict(app.config.get('JOURNAL') or {})
+        journal = None
+        replay_rate = None
+        if journal_config:
+            replay_rate = journal_config.pop('replay_rate', None)
+            journal = Journal(**journal_config)
+        return cls(send, ready=ready, journal=journal, replay_rate=replay_rate, **app.config.get('SEND_QUEUE', {}))
+
+    @property
+    def journal(self):
+        return self.__journal
+
+    def start(self):
+        self.__writer_thread.start()
+
+    def stats(self):
+        rv = dict(self.__stats)
+        rv['size'] = self.__queue.size()
+        return rv
+
+    def put(self, data, deadline=None):
+        """enqueue without blocking, return False if the message was discarded."""
+        deadline = deadline if deadline is not None else self.__deadline
+        expires = utime.ticks_add(utime.ticks_ms(), int(deadline * 1000)) if deadline is not None else None
+        item = (data, expires)
+        try:
+            self.__queue.put(item, block=False)
+        except Queue.Full:
+            self.__stats['overflow'] += 1
+            if self.__overflow == self.DROP_NEWEST:
+                return False
+            try:
+                self.__queue.get(block=False)
+                self.__queue.put(item, block=False)
+            except (Queue.Empty, Queue.Full):
+                return False
+        self.__stats['queued'] += 1
+        return True
+
+    @staticmethod
+    def __expired(expires):
+        return expires is not None and utime.ticks_diff(expires, utime.ticks_ms()) <= 0
+
+    def __is_ready(self):
+        return self.__ready is None or self.__ready()
+
+    def __store(self, data):
+        try:
+            self.__journal.append(data)
+        except Exception as e:
+            logger.error('journal append error: {}'.format(e))
+            return
+        self.__stats['journaled'] += 1
+
+    def writer_thread_worker(self):
+        journal = self.__journal
+        while True:
+            if journal is not None and journal.pending() and self.__is_ready():
+                # older journaled data goes out before queued data
+                journal.replay(self.__send, rate=self.__replay_rate)
+            try:
+                data, expires = self.__queue.get(timeout=1)
+            except Queue.Empty:
+                if journal is not None:
+                    journal.flush()
+                continue
+            if journal is not None and not self.__is_ready():
+                self.__store(data)
+                continue
+            while not self.__is_ready() and not self.__expired(expires):
+                utime.sleep_ms(200)
+            if self.__expired(expires):
+                self.__stats['stale'] += 1
+                continue
+            try:
+                ok = self.__send(data)
+            except Exception as e:
+                logger.error('async send error: {}'.format(e))
+                ok = False
+            self.__stats['sent' if ok else 'failed'] += 1
+            if not ok and journal is not None:
+                self.__store(data)
+
+
 class TcpClient(AppExtensionABC):
 
-    def __init__(self, name, app=None):
-        self.__sock = None
+    def __init__(self, name, app=None, recv_buf_size=1024, reconnect_policy=None):
+        self.__pool = None
+        self.__active = None
+        self.__standby = None
+        self.__warm_standby = True
+        self.__probe_interval = 300
+        # persistent receive buffer, `recv_callback` gets a memoryview slice of it.
+        self.__recv_buf = bytearray(recv_buf_size)
+        self.__recv_view = memoryview(self.__recv_buf)
         self.__listen_thread = Thread(target=self.listen_thread_worker)
-        self.__reconn_cond = Condition()
+        self.__policy = reconnect_policy
+        self.__reconn_lock = Lock()
+        self.__write_lock = Lock()
         self.__reconn_thread = Thread(target=self.reconn_thread_worker)
+        self.__probe_thread = Thread(target=self.probe_thread_worker)
+        self.__sender = None
         super().__init__(name, app=app)
 
     def __str__(self):
         return str(self.sock)
 
     def init_app(self, app):
-        self.__sock = TcpSocket(**app.config['TCP_SERVER'])
+        self.__pool = EndpointPool.from_config(app.config['TCP_SERVER'])
+        self.__active = self.__pool.ranked()[0]
+        pool_config = app.config.get('TCP_POOL', {})
+        self.__warm_standby = pool_config.get('warm_standby', True)
+        self.__probe_interval = pool_config.get('probe_interval', 300)
+        if self.__policy is None:
+            self.__policy = ReconnectPolicy(**app.config.get('TCP_RECONNECT', {}))
+        self.__sender = AsyncSender.from_config(app, self.send, ready=self.__policy.allow)
         app.append_extension(self)
 
     def load(self):
-        self.connect()
+        self.__sender.start()
+        if not self.connect():
+            self.reconnect()
+        if len(self.__pool.endpoints) > 1:
+            self.__probe_thread.start()
 
     @property
     def sock(self):
-        if self.__sock is None:
+        if self.__active is None:
             raise ValueError('client not init.')
-        return self.__sock
+        return self.__active.sock
+
+    @property
+    def policy(self):
+        return self.__policy
+
+    @property
+    def pool(self):
+        return self.__pool
+
+    @property
+    def sender(self):
+        return self.__sender
 
     def recv_callback(self, data):
+        """`data` is a memoryview on the client receive buffer, it is only valid until this method returns."""
         raise NotImplementedError('you must implement this method to handle data received by tcp.')
 
     def listen_thread_worker(self):
         while True:
+            sock = self.sock
             try:
-                data = self.sock.read(1024)
-            except self.sock.TimeoutError:
+                size = sock.read_into(self.__recv_buf)
+            except sock.TimeoutError:
                 # logger.debug('{} read timeout'.format(self))
                 continue
             except Exception as e:
-                logger.error('{} read error: {}'.format(self, e))
-                with self.__reconn_cond:
-                    self.__reconn_thread.start()
-                    self.__reconn_cond.notify()
-                break
+                logger.error('{} read error: {}'.format(sock, e))
             else:
-                try:
-                    self.recv_callback(data)
-                except Exception as e:
-                    logger.error('recv_callback error: {}'.format(e))
+                if size:
+                    try:
+                        self.recv_callback(self.__recv_view[:size])
+                    except Exception as e:
+                        logger.error('recv_callback error: {}'.format(e))
+                    continue
+                logger.warn('{} closed by peer'.format(sock))
+            if self.reconnect(sock):
+                # switched over to standby, keep listening on the new socket.
+                continue
+            break
 
     def disconnect(self):
         logger.info('{} disconnect'.format(self))
         try:
-            self.sock.disconnect()
+            with self.__pool.lock:
+                self.sock.disconnect()
+                if self.__standby is not None:
+                    self.__standby.sock.disconnect()
+                    self.__standby = None
             self.__listen_thread.stop()
         except Exception as e:
             logger.error('{} disconnect failed: {}'.format(self, e))
             return False
         return True
 
+    def connect(self):
+        """connect to the best ranked endpoint that accepts."""
+        with self.__pool.lock:
+            active = None
+            for endpoint in self.__pool.ranked(exclude=(self.__standby, )):
+                logger.info('{} connecting...'.format(endpoint))
+                try:
+                    endpoint.connect()
+                except Exception as e:
+                    logger.error('{} connect failed: {}'.format(endpoint, e))
+                    continue
+                active = self.__active = endpoint
+                break
+        if active is not None:
+            self.__listen_thread.start()
+            self.__policy.success()
+            logger.info('{} connect successfully'.format(active))
+            return True
+        self.__policy.failure()
+        return False
+
+    def __failover(self):
+        with self.__pool.lock:
+            standby = self.__standby
+            self.__standby = None
+            if standby is None or not standby.is_alive():
+                return False
+            failed = self.__active
+            self.__active = standby
+            failed.failures += 1
+            failed.sock.disconnect()
+        self.__listen_thread.start()
+        logger.warn('{} switch over to standby {}'.format(failed, standby))
+        return True
+
+    def reconnect(self, failed_sock=None):
+        """switch over to the warm standby if possible, otherwise open the circuit and start the reconnect thread.
+
+        @failed_sock: the socket that reported the error, ignored if it is no longer the active one.
+        @return: True if a connection is usable right now.
+        """
+        with self.__reconn_lock:
+            if failed_sock is not None and failed_sock is not self.sock:
+                return True
+            if self.__policy.allow() and self.__failover():
+                return True
+            self.__policy.failure()
+            self.__reconn_thread.start()
+            return False
+
+    def reconn_thread_worker(self):
+        # hold the reconnect lock while stopping the listen thread, so it is never killed inside `reconnect`
+        # with the lock held. the lock is released while backing off.
+        with self.__reconn_lock:
+            self.disconnect()
+        while True:
+            delay = self.__policy.next_delay()
+            logger.info('{} reconnect in {} ms'.format(self, int(delay * 1000)))
+            utime.sleep_ms(int(delay * 1000))
+            with self.__reconn_lock:
+                if self.connect():
+                    break
+                self.disconnect()
+
+    def probe_thread_worker(self):
+        while True:
+            for endpoint in self.__pool.endpoints:
+                # the active and standby endpoints are checked under the lock right before probing, they may
+                # have changed since the last endpoint was probed.
+                with self.__pool.lock:
+                    if endpoint is not self.__active and endpoint is not self.__standby:
+                        endpoint.probe()
+            if self.__warm_standby:
+                with self.__pool.lock:
+                    self.__prepare_standby()
+            utime.sleep(self.__probe_interval)
+
+    def __prepare_standby(self):
+        """called with the pool lock held."""
+        standby = self.__standby
+        if standby is not None:
+            if standby.is_alive():
+                return
+            standby.sock.disconnect()
+            self.__standby = None
+        if not self.__policy.allow():
+            return
+        for endpoint in self.__pool.ranked(exclude=(self.__active, )):
+            try:
+                endpoint.connect()
+            except Exception as e:
+                logger.warn('{} standby connect failed: {}'.format(endpoint, e))
+                continue
+            self.__standby = endpoint
+            logger.info('{} ready as warm standby'.format(endpoint))
+            break
+
+    def send(self, data):
+        if not self.__policy.allow():
+            return False
+        with self.__write_lock:
+            sock = self.sock
+            try:
+                return sock.write(data)
+            except Exception as e:
+                logger.error('cloud send error: {}; try to reconnect.'.format(e))
+                if not self.reconnect(sock):
+                    return False
+                sock = self.sock
+                try:
+                    return sock.write(data)
+                except Exception as e:
+                    logger.error('cloud send retry error: {}'.format(e))
+                    self.reconnect(sock)
+                    return False
+
+    def send_async(self, data, deadline=None):
+        """queue `data` for the writer thread and return immediately.
+
+        @deadline: message lifetime(s), overrides SEND_QUEUE.deadline.
+        @return: False if the message was discarded by the overflow policy.
+        """
+        return self.__sender.put(data, deadline=deadline)
+
+
+class UdpClient(AppExtensionABC):
+    """udp client with a lightweight reliability layer, same interface as `TcpClient`.
+
+    data datagram: type(1B) flags(1B) seq(2B) payload
+    ack datagram:  type(1B) flags(1B) ack_base(2B) bitmap(4B)
+    skip datagram: type(1B) flags(1B) seq(2B)
+
+    `ack_base` is the next sequence expected in order, bit i of `bitmap` acknowledges `ack_base + 1 + i`. the
+    sender keeps at most `window` datagrams in flight and only retransmits the unacknowledged ones, a datagram is
+    fast retransmitted after 3 duplicate acks. when the sender gives up on a datagram after `max_retries` it
+    sends skip datagrams until the receiver acks past it, the receiver then stops waiting for the sequences
+    before `seq`. the receiver drops duplicates and delivers payloads in sequence order. the peer must speak the
+    same framing. a failed connect is retried with the backoff of `reconnect_policy`, like `TcpClient`.
+    """
+    DATA = 0x01
+    ACK = 0x02
+    SKIP = 0x03
+    DUP_ACKS = 3
+    FLAG_RESET = 0x01  # first datagram of a stream, receiver resyncs its expected sequence
+    DATA_HEADER = '>BBH'
+    ACK_FORMAT = '>BBHI'
+    SEQ_MASK = 0xFFFF
+
+    def __init__(self, name, app=None, recv_buf_size=1024, reconnect_policy=None):
+        self.__sock = None
+        self.__policy = reconnect_policy
+        self.__window = 8
+        self.__rto = 2
+        self.__rto_ms = 2000
+        self.__max_retries = 5
+        self.__recv_buf = bytearray(recv_buf_size)
+        self.__recv_view = memoryview(self.__recv_buf)
+        self.__send_cond = Condition()
+        self.__next_seq = 0
+        self.__reset = True
+        self.__pending = {}  # seq -> [packet, deadline, retries]
+        self.__skip_to = None  # receiver must stop waiting for sequences before this one
+        self.__last_ack = None
+        self.__dup_acks = 0
+        self.__recv_lock = Lock()
+        self.__expected = 0
+        self.__reorder = {}  # seq -> payload received out of order
+        self.__stats = {
+            'tx_bytes': 0, 'rx_bytes': 0, 'retransmits': 0, 'duplicates': 0, 'dropped': 0, 'skipped': 0
+        }
+        self.__listen_thread = Thread(target=self.listen_thread_worker)
+        self.__retransmit_thread = Thread(target=self.retransmit_thread_worker)
+        self.__reconn_thread = Thread(target=self.reconn_thread_worker)
+        self.__sender = None
+        super().__init__(name, app=app)
+
+    def __str__(self):
+        return str(self.sock)
+
+    def init_app(self, app):
+        config = dict(app.config['UDP_SERVER'])
+        self.__window = config.pop('window', self.__window)
+        self.__rto = config.pop('rto', self.__rto)
+        self.__rto_ms = int(self.__rto * 1000)
+        self.__max_retries = config.pop('max_retries', self.__max_retries)
+        if not 0 < self.__window <= 32:
+            raise ValueError('udp window must be in range [1, 32].')
+        self.__sock = UdpSocket(**config)
+        if self.__policy is None:
+            self.__policy = ReconnectPolicy(**app.config.get('UDP_RECONNECT', {}))
+        self.__sender = AsyncSender.from_config(app, self.send, ready=self.__policy.allow)
+        app.append_extension(self)
+
+    def load(self):
+        self.__sender.start()
+        if not self.connect():
+            self.reconnect()
+
+    @property
+    def sock(self):
+        if self.__sock is None:
+            raise ValueError('client not init.')
+        return self.__sock
+
+    @property
+    def policy(self):
+        return self.__policy
+
+    def stats(self):
+        rv = dict(self.__stats)
+        rv['in_flight'] = len(self.__pending)
+        return rv
+
+    def recv_callback(self, data):
+        """`data` may be a memoryview on the client receive buffer, it is only valid until this method returns."""
+        raise NotImplementedError('you must implement this method to handle data received by udp.')
+
     def connect(self):
         logger.info('{} connecting...'.format(self))
         try:
             self.sock.connect()
         except Exception as e:
             logger.error('{} connect failed: {}'.format(self, e))
+            self.sock.disconnect()
+            self.__policy.failure()
             return False
+        with self.__send_cond:
+            self.__reset = True
+            self.__skip_to = None
         self.__listen_thread.start()
+        self.__retransmit_thread.start()
+        self.__policy.success()
         logger.info('{} connect successfully'.format(self))
         return True
 
+    def reconnect(self):
+        """open the circuit and retry `connect` with backoff in the reconnect thread."""
+        self.__policy.failure()
+        self.__reconn_thread.start()
+
     def reconn_thread_worker(self):
-        with self.__reconn_cond:
-            self.disconnect()
-            while not self.connect():
-                last_reconn_time = DateTime.now()
-                self.disconnect()
-                self.__reconn_cond.wait_for(
-                    lambda: DateTime.now() - last_reconn_time > TimeDelta(seconds=10),
-                    timeout=60
-                )
+        while True:
+            delay = self.__policy.next_delay()
+            logger.info('{} reconnect in {} ms'.format(self, int(delay * 1000)))
+            utime.sleep_ms(int(delay * 1000))
+            if self.connect():
+                break
 
-    def send(self, data):
-        with self.__reconn_cond:
+    def disconnect(self):
+        logger.info('{} disconnect'.format(self))
+        try:
+            self.sock.disconnect()
+            self.__listen_thread.stop()
+            self.__retransmit_thread.stop()
+        except Exception as e:
+            logger.error('{} disconnect failed: {}'.format(self, e))
+            return False
+        return True
+
+    @classmethod
+    def __seq_before(cls, a, b):
+        """sequence `a` is before `b` (modulo 2**16)."""
+        return 0 < ((b - a) & cls.SEQ_MASK) < 0x8000
+
+    def __transmit(self, packet):
+        try:
+            rv = self.sock.write(packet)
+        except Exception as e:
+            logger.error('{} send error: {}'.format(self, e))
+            return False
+        self.__stats['tx_bytes'] += len(packet)
+        return rv
+
+    def send(self, data, timeout=None):
+        """queue `data` in the send window and transmit it, wait up to `timeout` seconds for window space."""
+        if not self.__policy.allow():
+            return False
+        with self.__send_cond:
+            if not self.__send_cond.wait_for(
+                lambda: len(self.__pending) < self.__window,
+                timeout=timeout or self.__rto * self.__max_retries
+            ):
+                logger.warn('{} send window full.'.format(self))
+                return False
+            seq = self.__next_seq
+            self.__next_seq = (seq + 1) & self.SEQ_MASK
+            flags = self.FLAG_RESET if self.__reset else 0
+            self.__reset = False
+            packet = struct.pack(self.DATA_HEADER, self.DATA, flags, seq) + data
+            self.__pending[seq] = [packet, utime.ticks_add(utime.ticks_ms(), self.__rto_ms), 0]
+        return self.__transmit(packet)
+
+    def send_async(self, data, deadline=None):
+        """queue `data` for the writer thread and return immediately, see `TcpClient.send_async`."""
+        return self.__sender.put(data, deadline=deadline)
+
+    def listen_thread_worker(self):
+        while True:
             try:
-                return self.sock.write(data)
+                size = self.sock.read_into(self.__recv_buf)
+            except self.sock.TimeoutError:
+                continue
             except Exception as e:
-                logger.error('cloud send error: {}; try to reconnect.'.format(e))
-                self.__reconn_thread.start()
-                self.__reconn_cond.notify()
-                return False
+                logger.error('{} read error: {}'.format(self, e))
+                utime.sleep(1)
+                continue
+            if size < 4:
+                continue
+            self.__stats['rx_bytes'] += size
+            kind, flags, seq = struct.unpack_from(self.DATA_HEADER, self.__recv_buf)
+            try:
+                if kind == self.DATA:
+                    self.__on_data(flags, seq, self.__recv_view[4:size])
+                elif kind == self.ACK and size >= 8:
+                    self.__on_ack(seq, struct.unpack_from('>I', self.__recv_buf, 4)[0])
+                elif kind == self.SKIP:
+                    self.__on_skip(seq)
+            except Exception as e:
+                logger.error('recv_callback error: {}'.format(e))
+
+    def __drain(self, deliver):
+        """called with the receive lock held, move in order payloads from the reorder buffer to `deliver`."""
+        while self.__expected in self.__reorder:
+            deliver.append(self.__reorder.pop(self.__expected))
+            self.__expected = (self.__expected + 1) & self.SEQ_MASK
+
+    def __ack_packet(self):
+        """called with the receive lock held."""
+        bitmap = 0
+        for i in range(32):
+            if ((self.__expected + 1 + i) & self.SEQ_MASK) in self.__reorder:
+                bitmap |= 1 << i
+        return struct.pack(self.ACK_FORMAT, self.ACK, 0, self.__expected, bitmap)
+
+    def __on_data(self, flags, seq, payload):
+        deliver = []
+        with self.__recv_lock:
+            if flags & self.FLAG_RESET:
+                # keep what already arrived after a (possibly retransmitted) reset datagram
+                self.__expected = seq
+                for buffered in list(self.__reorder.keys()):
+                    if not 0 < ((buffered - seq) & self.SEQ_MASK) <= 32:
+                        del self.__reorder[buffered]
+            offset = (seq - self.__expected) & self.SEQ_MASK
+            if offset >= 0x8000 or seq in self.__reorder:
+                self.__stats['duplicates'] += 1
+            elif offset == 0:
+                # in order, hand out the receive buffer without copying
+                deliver.append(payload)
+                self.__expected = (seq + 1) & self.SEQ_MASK
+            elif offset <= 32:
+                self.__reorder[seq] = bytes(payload)
+            self.__drain(deliver)
+            ack = self.__ack_packet()
+        self.__transmit(ack)
+        for data in deliver:
+            self.recv_callback(data)
+
+    def __on_skip(self, seq):
+        deliver = []
+        with self.__recv_lock:
+            while self.__seq_before(self.__expected, seq):
+                if self.__expected in self.__reorder:
+                    deliver.append(self.__reorder.pop(self.__expected))
+                else:
+                    self.__stats['skipped'] += 1
+                self.__expected = (self.__expected + 1) & self.SEQ_MASK
+            self.__drain(deliver)
+            ack = self.__ack_packet()
+        self.__transmit(ack)
+        for data in deliver:
+            self.recv_callback(data)
+
+    def __on_ack(self, base, bitmap):
+        fast_retransmit = None
+        with self.__send_cond:
+            for seq in list(self.__pending.keys()):
+                offset = (seq - base - 1) & self.SEQ_MASK
+                if self.__seq_before(seq, base) or (offset < 32 and bitmap >> offset & 1):
+                    del self.__pending[seq]
+            if self.__skip_to is not None and not self.__seq_before(base, self.__skip_to):
+                self.__skip_to = None
+            if base == self.__last_ack and bitmap:
+                self.__dup_acks += 1
+            else:
+                self.__last_ack = base
+                self.__dup_acks = 0
+            if self.__dup_acks == self.DUP_ACKS and base in self.__pending:
+                # later datagrams keep arriving, the base one is lost. only once per run of duplicate acks,
+                # the retransmit timer restarts from now.
+                item = self.__pending[base]
+                item[1] = utime.ticks_add(utime.ticks_ms(), self.__rto_ms)
+                fast_retransmit = item[0]
+            self.__send_cond.notify_all()
+        if fast_retransmit is not None:
+            self.__stats['retransmits'] += 1
+            self.__transmit(fast_retransmit)
+
+    def __low_water(self):
+        """called with the send lock held, the oldest sequence still in flight or the next one to send."""
+        oldest = self.__next_seq
+        for seq in self.__pending:
+            if self.__seq_before(seq, oldest):
+                oldest = seq
+        return oldest
+
+    def retransmit_thread_worker(self):
+        interval = max(1, min(self.__rto_ms // 4, 200))
+        while True:
+            utime.sleep_ms(interval)
+            now = utime.ticks_ms()
+            packets = []
+            with self.__send_cond:
+                for seq, item in list(self.__pending.items()):
+                    if utime.ticks_diff(item[1], now) > 0:
+                        continue
+                    if item[2] >= self.__max_retries:
+                        del self.__pending[seq]
+                        self.__stats['dropped'] += 1
+                        self.__skip_to = self.__low_water()
+                        logger.warn('{} drop seq {} after {} retries.'.format(self, seq, item[2]))
+                        continue
+                    item[2] += 1
+                    item[1] = utime.ticks_add(now, self.__rto_ms << item[2])
+                    packets.append(item[0])
+                if self.__skip_to is not None:
+                    packets.append(struct.pack(self.DATA_HEADER, self.SKIP, 0, self.__skip_to))
+                if len(self.__pending) < self.__window:
+                    self.__send_cond.notify_all()
+            for packet in packets:
+                if packet[0] == self.DATA:
+                    self.__stats['retransmits'] += 1
+                self.__transmit(packet)
 
 
 class SmsClient(AppExtensionABC):
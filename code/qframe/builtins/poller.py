@@ -0,0 +1,161 @@
+import utime
+import ubinascii
+from .. import AppExtensionABC
+from ..threading import Thread
+from ..logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+def _device_id():
+    try:
+        import modem
+        return modem.getDevImei()
+    except Exception:
+        return ''
+
+
+class CronExpr(object):
+    """5 fields cron expression: minute hour day month weekday(0 is Sunday).
+
+    each field accepts `*`, `n`, `a-b`, `*/n`, `a-b/n` and comma separated lists of them.
+    """
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('invalid cron expression \"{}\".'.format(expr))
+        self.expr = expr
+        self.fields = [self.__parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+
+    @staticmethod
+    def __parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(v) for v in part.split('-')]
+            else:
+                start = end = int(part)
+            if start < low or end > high or step < 1:
+                raise ValueError('cron field \"{}\" out of range.'.format(field))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def match(self, time_tuple):
+        # localtime weekday is 0 for Monday
+        values = (time_tuple[4], time_tuple[3], time_tuple[2], time_tuple[1], (time_tuple[6] + 1) % 7)
+        return all(value in field for value, field in zip(values, self.fields))
+
+
+class Schedule(object):
+    """one polling group, runs every `interval` seconds or at `cron` minutes, shifted by `offset` seconds."""
+
+    def __init__(self, name, params, interval=None, cron=None, offset=0):
+        if (interval is None) == (cron is None):
+            raise ValueError('schedule \"{}\" needs exactly one of interval or cron.'.format(name))
+        self.name = name
+        self.params = params
+        self.interval = interval
+        self.cron = CronExpr(cron) if cron is not None else None
+        self.offset = offset % interval if interval else offset
+        self.__next_due = None
+        self.__last_minute = None
+        self.stats = {'runs': 0, 'last_lateness': 0, 'max_lateness': 0, 'total_lateness': 0}
+
+    def __str__(self):
+        return '<Schedule {}>'.format(self.name)
+
+    def due(self, now):
+        """return the due timestamp if the schedule should run at `now`, else None."""
+        if self.interval:
+            if self.__next_due is None:
+                # align to interval boundaries so the whole fleet shares the slots, spread by offset
+                self.__next_due = (now - self.offset) // self.interval * self.interval + self.interval + self.offset
+        else:
+            minute = now // 60
+            if minute != self.__last_minute:
+                self.__last_minute = minute
+                if self.__next_due is None and self.cron.match(utime.localtime(now)):
+                    self.__next_due = minute * 60 + self.offset
+        if self.__next_due is not None and now >= self.__next_due:
+            return self.__next_due
+        return None
+
+    def done(self, due, started):
+        lateness = started - due
+        self.stats['runs'] += 1
+        self.stats['last_lateness'] = lateness
+        self.stats['total_lateness'] += lateness
+        if lateness > self.stats['max_lateness']:
+            self.stats['max_lateness'] = lateness
+        self.__next_due = due + self.interval if self.interval else None
+        if self.interval and self.__next_due <= started:
+            # skip the slots missed while busy
+            self.__next_due += (started - self.__next_due) // self.interval * self.interval + self.interval
+
+
+class Poller(AppExtensionABC):
+    """periodic polling engine configured by POLLING in dev.json, started only when POLLING.enable is true.
+
+    every group gets a deterministic offset in [0, jitter) seconds derived from the device id and the group name,
+    so a fleet spreads its load. groups due at the same time are coalesced into one `poll_callback` call.
+    """
+
+    def __init__(self, name, app=None):
+        self.schedules = []
+        self.__poll_thread = Thread(target=self.poll_thread_worker)
+        super().__init__(name, app=app)
+
+    def init_app(self, app):
+        config = app.config.get('POLLING', {})
+        device_id = config.get('device_id') or _device_id()
+        jitter = config.get('jitter', 0)
+        for group, item in config.get('groups', {}).items():
+            offset = ubinascii.crc32('{}:{}'.format(device_id, group).encode()) % jitter if jitter else 0
+            params = [int(param_id, 16) for param_id in item['params']]
+            self.schedules.append(
+                Schedule(group, params, interval=item.get('interval'), cron=item.get('cron'), offset=offset)
+            )
+        app.append_extension(self)
+
+    def load(self):
+        if self.schedules:
+            self.__poll_thread.start()
+
+    def poll_callback(self, param_ids, groups):
+        raise NotImplementedError('you must implement this method to poll params.')
+
+    def stats(self):
+        return {schedule.name: dict(schedule.stats) for schedule in self.schedules}
+
+    def poll_thread_worker(self):
+        while True:
+            now = utime.time()
+            due = []
+            for schedule in self.schedules:
+                due_time = schedule.due(now)
+                if due_time is not None:
+                    due.append((schedule, due_time))
+            if due:
+                param_ids = []
+                for schedule, _ in due:
+                    for param_id in schedule.params:
+                        if param_id not in param_ids:
+                            param_ids.append(param_id)
+                try:
+                    self.poll_callback(param_ids, [schedule.name for schedule, _ in due])
+                except Exception as e:
+                    logger.error('poll_callback error: {}'.format(e))
+                for schedule, due_time in due:
+                    schedule.done(due_time, now)
+                    if schedule.stats['last_lateness'] > 1:
+                        logger.warn('{} late by {}s'.format(schedule, schedule.stats['last_lateness']))
+            utime.sleep(1)
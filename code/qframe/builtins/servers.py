@@ -0,0 +1,213 @@
+import utime
+from .. import AppExtensionABC
+from ..threading import Condition, Lock, Thread
+from ..qsocket import TcpServerSocket
+from ..logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Session(object):
+    """one inbound connection, reads into its own fixed size buffer."""
+
+    def __init__(self, server, sock, recv_buf_size=1024):
+        self.server = server
+        self.sock = sock
+        self.__recv_buf = bytearray(recv_buf_size)
+        self.__recv_view = memoryview(self.__recv_buf)
+        self.__write_lock = Lock()
+        self.__listen_thread = Thread(target=self.listen_thread_worker)
+        self.closed = False
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+
+    def __str__(self):
+        return '<Session {}>'.format(self.sock)
+
+    def start(self):
+        self.__listen_thread.start()
+
+    def listen_thread_worker(self):
+        while not self.closed:
+            try:
+                size = self.sock.read_into(self.__recv_buf)
+            except self.sock.TimeoutError:
+                continue
+            except Exception as e:
+                logger.error('{} read error: {}'.format(self, e))
+                break
+            if not size:
+                # peer closed
+                break
+            self.rx_bytes += size
+            try:
+                self.server.dispatch(self, self.__recv_view[:size])
+            except Exception as e:
+                logger.error('{} dispatch error: {}'.format(self, e))
+        self.server.close_session(self)
+
+    def write(self, data):
+        with self.__write_lock:
+            try:
+                rv = self.sock.write(data)
+            except Exception as e:
+                logger.error('{} send error: {}'.format(self, e))
+                rv = False
+        if rv:
+            self.tx_bytes += len(data)
+        else:
+            self.server.close_session(self)
+        return rv
+
+    def close(self):
+        self.closed = True
+        self.sock.disconnect()
+
+
+class TcpServer(AppExtensionABC):
+    """accept HES connections and arbitrate access to the meter between them.
+
+    only one owner talks to the meter at a time. an owner keeps the meter for `lease` seconds after its last
+    activity, other sessions wait for the lease to end before their data is passed to `recv_callback`. a
+    `TcpClient` can take part in the arbitration too by calling `acquire` with itself as owner.
+    """
+
+    def __init__(self, name, app=None, recv_buf_size=1024):
+        self.__sock = None
+        self.__recv_buf_size = recv_buf_size
+        self.__max_sessions = 4
+        self.__lease = 5
+        self.__sessions = []
+        self.__sessions_lock = Lock()
+        self.__owner = None
+        self.__lease_until = 0
+        self.__owner_cond = Condition()
+        self.__closed = False
+        self.__accept_thread = Thread(target=self.accept_thread_worker)
+        super().__init__(name, app=app)
+
+    def __str__(self):
+        return str(self.sock)
+
+    def init_app(self, app):
+        config = dict(app.config['TCP_LISTEN'])
+        self.__max_sessions = config.pop('max_sessions', self.__max_sessions)
+        self.__lease = config.pop('lease', self.__lease)
+        self.__sock = TcpServerSocket(**config)
+        app.append_extension(self)
+
+    def load(self):
+        self.__closed = False
+        self.sock.listen()
+        self.__accept_thread.start()
+        logger.info('{} listening'.format(self))
+
+    def close(self):
+        """stop accepting, close the listening socket and every session."""
+        with self.__sessions_lock:
+            self.__closed = True
+        self.__accept_thread.stop()
+        self.sock.close()
+        for session in self.sessions:
+            self.close_session(session)
+        logger.info('{} closed'.format(self))
+
+    @property
+    def sock(self):
+        if self.__sock is None:
+            raise ValueError('server not init.')
+        return self.__sock
+
+    @property
+    def sessions(self):
+        with self.__sessions_lock:
+            return list(self.__sessions)
+
+    @property
+    def owner(self):
+        return self.__owner
+
+    def recv_callback(self, session, data):
+        """`data` is a memoryview on the session receive buffer, it is only valid until this method returns."""
+        raise NotImplementedError('you must implement this method to handle data received by tcp server.')
+
+    def accept_thread_worker(self):
+        while not self.__closed:
+            try:
+                sock = self.sock.accept()
+            except Exception as e:
+                if self.__closed:
+                    break
+                logger.error('{} accept error: {}'.format(self, e))
+                utime.sleep(1)
+                continue
+            with self.__sessions_lock:
+                if self.__closed:
+                    sock.disconnect()
+                    break
+                if len(self.__sessions) >= self.__max_sessions:
+                    logger.warn('{} reject {}, too many sessions.'.format(self, sock))
+                    sock.disconnect()
+                    continue
+                session = Session(self, sock, recv_buf_size=self.__recv_buf_size)
+                self.__sessions.append(session)
+            logger.info('{} accept {}'.format(self, session))
+            session.start()
+
+    def close_session(self, session):
+        with self.__sessions_lock:
+            if session not in self.__sessions:
+                return
+            self.__sessions.remove(session)
+        session.close()
+        self.release(session)
+        logger.info('{} close {}'.format(self, session))
+
+    def __is_free_for(self, owner):
+        return (self.__owner is None
+                or self.__owner is owner
+                or utime.ticks_diff(self.__lease_until, utime.ticks_ms()) <= 0)
+
+    def acquire(self, owner, timeout=None):
+        """take (or renew) ownership of the meter, waiting up to `timeout` seconds(default one lease)."""
+        with self.__owner_cond:
+            if not self.__owner_cond.wait_for(lambda: self.__is_free_for(owner), timeout=timeout or self.__lease):
+                return False
+            self.__owner = owner
+            self.__lease_until = utime.ticks_add(utime.ticks_ms(), self.__lease * 1000)
+            return True
+
+    def release(self, owner):
+        with self.__owner_cond:
+            if self.__owner is owner:
+                self.__owner = None
+                self.__owner_cond.notify_all()
+
+    def dispatch(self, session, data):
+        if not self.acquire(session):
+            logger.warn('{} drop {} bytes, meter busy with {}'.format(session, len(data), self.__owner))
+            return
+        self.recv_callback(session, data)
+
+    def send(self, data):
+        """send meter data to the owning session.
+
+        @return: None if the meter is not owned by a session of this server (or its lease expired), otherwise the
+        write result.
+        """
+        with self.__owner_cond:
+            owner = self.__owner
+            if not isinstance(owner, Session):
+                return None
+            if utime.ticks_diff(self.__lease_until, utime.ticks_ms()) <= 0:
+                # stale owner, unsolicited meter data goes to the client instead
+                self.__owner = None
+                self.__owner_cond.notify_all()
+                return None
+        if not owner.write(data):
+            return False
+        with self.__owner_cond:
+            if self.__owner is owner:
+                self.__lease_until = utime.ticks_add(utime.ticks_ms(), self.__lease * 1000)
+        return True
@@ -1,5 +1,16 @@
+import uos
+import usys
+import ujson
+import utime
 import ql_fs
 import _thread
+import ubinascii
+import ustruct as struct
+from .threading import Thread
+from .logging import getLogger
+
+
+logger = getLogger(__name__)
 
 
 class Singleton(object):
@@ -68,6 +79,33 @@ class OrderedDict(object):
             yield curr.key
             curr = curr.next
 
+    def __contains__(self, key):
+        return key in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+    def move_to_end(self, key, last=True):
+        link = self._node_map[key]
+        link.prev.next, link.next.prev = link.next, link.prev
+        root = self.root
+        if last:
+            link.prev, link.next = root.prev, root
+            root.prev.next = link
+            root.prev = link
+        else:
+            link.prev, link.next = root, root.next
+            root.next.prev = link
+            root.next = link
+
+    def popitem(self, last=True):
+        if not self.map:
+            raise KeyError('dictionary is empty')
+        key = self.root.prev.key if last else self.root.next.key
+        value = self.map[key]
+        del self[key]
+        return key, value
+
     def pop(self, key, default=None):
         if key not in self:
             return default
@@ -96,6 +134,143 @@ class OrderedDict(object):
             self[k] = v
 
 
+class _NoLock(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """least recently used cache of at most `maxsize` entries, every operation is O(1).
+
+    the least recently used entry is evicted when full. `thread_safe` guards every operation with a lock.
+    """
+
+    def __init__(self, maxsize=128, thread_safe=False):
+        if maxsize < 1:
+            raise ValueError('maxsize must be greater than 0.')
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = _thread.allocate_lock() if thread_safe else _NoLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not _MISSING
+
+    def _lookup(self, key):
+        """return the stored value of `key` or _MISSING, subclasses may expire it here."""
+        return self._data.map.get(key, _MISSING)
+
+    def _store(self, key, value):
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, *args):
+        with self._lock:
+            self._data[key] = self._store(key, value, *args)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                return default
+            del self._data[key]
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data = OrderedDict()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose entries expire `ttl` seconds after they were put, expired entries are dropped lazily."""
+
+    def __init__(self, maxsize=128, ttl=60, thread_safe=False):
+        super().__init__(maxsize=maxsize, thread_safe=thread_safe)
+        self.ttl = ttl
+        self.expirations = 0
+
+    def _lookup(self, key):
+        item = self._data.map.get(key)
+        if item is None:
+            return _MISSING
+        expires, value = item
+        if utime.ticks_diff(expires, utime.ticks_ms()) <= 0:
+            del self._data[key]
+            self.expirations += 1
+            return _MISSING
+        return value
+
+    def _store(self, key, value, ttl=None):
+        return utime.ticks_add(utime.ticks_ms(), int((self.ttl if ttl is None else ttl) * 1000)), value
+
+    def put(self, key, value, ttl=None):
+        """put `value` for `ttl` seconds, default to the cache ttl."""
+        super().put(key, value, ttl)
+
+    def stats(self):
+        rv = super().stats()
+        rv['expirations'] = self.expirations
+        return rv
+
+
+class _Memoized(object):
+
+    def __init__(self, func, cache):
+        self.func = func
+        self.cache = cache
+
+    def __call__(self, *args, **kwargs):
+        # the sentinel keeps f(1, ("a", 2)) and f(1, a=2) apart
+        key = args + (_MISSING, ) + tuple(sorted(kwargs.items())) if kwargs else args
+        value = self.cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.func(*args, **kwargs)
+            self.cache.put(key, value)
+        return value
+
+
+def memoize(maxsize=128, ttl=None):
+    """cache the results of a function by its (hashable) arguments in a thread safe LRUCache, or a TTLCache when
+    `ttl` seconds is given. the cache is available as the `cache` attribute of the decorated function.
+    """
+    def decorator(func):
+        if ttl is None:
+            cache = LRUCache(maxsize=maxsize, thread_safe=True)
+        else:
+            cache = TTLCache(maxsize=maxsize, ttl=ttl, thread_safe=True)
+        return _Memoized(func, cache)
+    return decorator
+
+
 def deepcopy(obj):
     if isinstance(obj, (int, float, str, bool, type(None))):
         return obj
@@ -107,41 +282,361 @@ def deepcopy(obj):
         raise TypeError('unsupported for \"{}\" type'.format(type(obj)))
 
 
+class FrozenDict(dict):
+    """read only dict used for LocalStorage snapshots, copy it with `dict()` or `deepcopy()` to modify."""
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict is read only.')
+
+    __setitem__ = __delitem__ = pop = popitem = setdefault = update = clear = __readonly
+
+
+def freeze(obj):
+    """build an immutable copy of `obj`, dict becomes FrozenDict and list becomes tuple."""
+    if isinstance(obj, FrozenDict):
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(item) for item in obj)
+    return obj
+
+
+def _atomic_write(path, data):
+    """write to a temp file then rename it over `path`, a power cut leaves either the old or the new file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+    try:
+        uos.rename(tmp, path)
+    except OSError:
+        # some file systems refuse to rename over an existing file
+        uos.remove(path)
+        uos.rename(tmp, path)
+
+
+def _recover(path):
+    """finish an `_atomic_write` cut between removing `path` and renaming the temp file over it."""
+    tmp = path + '.tmp'
+    if not ql_fs.path_exists(path) and ql_fs.path_exists(tmp):
+        logger.warn('restore {} from {}'.format(path, tmp))
+        uos.rename(tmp, path)
+
+
 class LocalStorage(object):
+    """versioned key value storage.
+
+    readers get the current frozen snapshot without locking or copying, writers build a new snapshot under the lock
+    and swap it in. `watch` registers callbacks called with (key, value) after a key changed.
+    saves are atomic and skipped when nothing changed since the last one, see `persist` for write-behind and A/B slots.
+    """
 
     def __init__(self):
         self.__path = None
-        self.__db = {}
+        self.__db = FrozenDict()
+        self.__version = 0
+        self.__saved_version = 0
+        self.__watchers = {}
         self.__lock = _thread.allocate_lock()
+        self.__debounce = None
+        self.__last_change = None
+        self.__autosave_thread = Thread(target=self.__autosave_worker)
+        self.__slots = False
+        self.__slot_seq = 0
+
+    def persist(self, debounce=None, slots=False):
+        """configure persistence, call it before `from_json`.
+
+        @debounce: ms, save automatically once no change happened for `debounce` ms, None to save only on `save()`.
+        @slots: keep two checksummed copies `<path>.a` and `<path>.b`, saves overwrite the older one and
+        `from_json` loads the newest valid one, falling back to `path`.
+        """
+        self.__debounce = debounce
+        self.__slots = slots
+
+    @property
+    def version(self):
+        return self.__version
+
+    def snapshot(self):
+        return self.__db
+
+    def watch(self, key, callback):
+        with self.__lock:
+            self.__watchers.setdefault(key, []).append(callback)
 
-    def from_json(self, path):
+    def unwatch(self, key, callback):
         with self.__lock:
-            self.__path = path
+            callbacks = self.__watchers.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def __swap(self, items):
+        """merge `items` into a new snapshot, then notify watchers of changed keys."""
+        with self.__lock:
+            db = dict(self.__db)
+            changed = []
+            for k, v in items:
+                v = freeze(v)
+                if k not in db or db[k] != v:
+                    changed.append((k, v, list(self.__watchers.get(k, []))))
+                db[k] = v
+            if not changed:
+                return
+            self.__db = FrozenDict(db)
+            self.__version += 1
+            self.__last_change = utime.ticks_ms()
+        if self.__debounce is not None:
+            self.__autosave_thread.start()
+        for k, v, callbacks in changed:
+            for callback in callbacks:
+                try:
+                    callback(k, v)
+                except Exception as e:
+                    usys.print_exception(e)
+
+    @staticmethod
+    def __slot_path(path, seq):
+        return path + ('.a' if seq % 2 else '.b')
+
+    @staticmethod
+    def __read_slot(slot_path):
+        """slot file: crc32(hex) seq newline json, return (seq, data) or None if missing or corrupted."""
+        try:
+            with open(slot_path, 'r') as f:
+                crc, seq = f.readline().split()
+                body = f.read()
+            if int(crc, 16) != ubinascii.crc32(body.encode()):
+                return None
+            return int(seq), ujson.loads(body)
+        except Exception:
+            return None
+
+    def from_json(self, path):
+        self.__path = path
+        data = None
+        if self.__slots:
+            for slot_path in (path + '.a', path + '.b'):
+                _recover(slot_path)
+            slots = [slot for slot in (self.__read_slot(path + '.a'), self.__read_slot(path + '.b')) if slot]
+            if slots:
+                self.__slot_seq, data = max(slots, key=lambda slot: slot[0])
+        if data is None:
+            _recover(path)
             if not ql_fs.path_exists(path):
                 raise ValueError('\"{}\" not exists!'.format(path))
-            self.__db.update(ql_fs.read_json(path))
+            data = ql_fs.read_json(path)
+        self.__swap(data.items())
+        self.__saved_version = self.__version
 
-    def save(self, to_path=None):
+    def save(self, to_path=None, force=False):
+        """save if changed since the last save, return True if written."""
         with self.__lock:
+            own = to_path is None or to_path == self.__path
             to_path = to_path or self.__path
             if to_path is None:
                 raise ValueError('no path to save.')
-            ql_fs.touch(to_path, self.__db)
+            version = self.__version
+            if own and not force and version == self.__saved_version:
+                return False
+            body = ujson.dumps(deepcopy(self.__db))
+            if own and self.__slots:
+                self.__slot_seq += 1
+                body = '{:08x} {}\n{}'.format(ubinascii.crc32(body.encode()), self.__slot_seq, body)
+                to_path = self.__slot_path(to_path, self.__slot_seq)
+            _atomic_write(to_path, body)
+            if own:
+                self.__saved_version = version
+        return True
+
+    def __autosave_worker(self):
+        while True:
+            utime.sleep_ms(self.__debounce)
+            if self.__version == self.__saved_version:
+                continue
+            if utime.ticks_diff(utime.ticks_ms(), self.__last_change) >= self.__debounce:
+                try:
+                    self.save()
+                except Exception as e:
+                    usys.print_exception(e)
 
     def update(self, *args, **kwargs):
-        with self.__lock:
-            self.__db.update(*args, **kwargs)
+        self.__swap(dict(*args, **kwargs).items())
         return self
 
     def get(self, key, default=None):
-        with self.__lock:
-            return deepcopy(self.__db.get(key, default))
+        return self.__db.get(key, default)
 
     def __getitem__(self, key):
-        with self.__lock:
-            return deepcopy(self.__db[key])
+        return self.__db[key]
 
     def __setitem__(self, key, value):
-        with self.__lock:
-            self.__db[key] = value
+        self.__swap(((key, value),))
         return self
+
+
+class KVStore(object):
+    """append-only key value store on flash for high churn state such as counters and cursors.
+
+    every put/delete appends a record flags(1B) key_len(2B) value_len(2B) crc32(4B) key value, values are json.
+    an in RAM index maps key -> (value offset, value length, record size), so a read is one seek. the file is
+    scanned on open and stops at the first torn record. when garbage exceeds `compact_ratio` of `max_size` the live
+    records are rewritten in a background thread, the file never grows beyond `max_size` bytes.
+    """
+    HEADER = '>BHHI'
+    HEADER_SIZE = 9
+    FLAG_DELETED = 0x01
+
+    def __init__(self, path, max_size=16384, compact_ratio=0.5):
+        self.__path = path
+        self.__max_size = max_size
+        self.__compact_ratio = compact_ratio
+        self.__index = {}
+        self.__live = 0
+        self.__end = 0
+        self.__fp = None
+        self.__lock = _thread.allocate_lock()
+        self.__compact_thread = Thread(target=self.compact)
+        self.__stats = {'puts': 0, 'deletes': 0, 'compactions': 0, 'torn': 0}
+        self.__open()
+
+    def __str__(self):
+        return '<KVStore {}>'.format(self.__path)
+
+    def __open(self):
+        # a compaction cut between removing the store and renaming the temp file over it
+        _recover(self.__path)
+        if not ql_fs.path_exists(self.__path):
+            open(self.__path, 'wb').close()
+        self.__fp = open(self.__path, 'r+b')
+        self.__index = {}
+        self.__live = 0
+        offset = 0
+        torn = False
+        while True:
+            header = self.__fp.read(self.HEADER_SIZE)
+            if len(header) < self.HEADER_SIZE:
+                torn = bool(header)
+                break
+            flags, key_len, value_len, crc = struct.unpack(self.HEADER, header)
+            body = self.__fp.read(key_len + value_len)
+            if len(body) < key_len + value_len or ubinascii.crc32(body) != crc:
+                torn = True
+                break
+            key = body[:key_len].decode()
+            size = self.HEADER_SIZE + key_len + value_len
+            self.__forget(key)
+            if not flags & self.FLAG_DELETED:
+                self.__index[key] = (offset + self.HEADER_SIZE + key_len, value_len, size)
+                self.__live += size
+            offset += size
+        self.__end = offset
+        if torn:
+            # appends behind a torn record would be lost on the next scan, rewrite the live records now.
+            self.__stats['torn'] += 1
+            self.__compact()
+
+    def __forget(self, key):
+        entry = self.__index.pop(key, None)
+        if entry is not None:
+            self.__live -= entry[2]
+
+    def __read_value(self, entry):
+        self.__fp.seek(entry[0])
+        return self.__fp.read(entry[1])
+
+    @classmethod
+    def __record(cls, key, value, flags=0):
+        body = key + value
+        return struct.pack(cls.HEADER, flags, len(key), len(value), ubinascii.crc32(body)) + body
+
+    def __append(self, key, record, deleted):
+        if self.__end + len(record) > self.__max_size:
+            self.__compact()
+            if self.__end + len(record) > self.__max_size:
+                raise ValueError('{} is full.'.format(self))
+        self.__fp.seek(self.__end)
+        self.__fp.write(record)
+        self.__fp.flush()
+        self.__forget(key.decode())
+        if not deleted:
+            value_offset = self.__end + self.HEADER_SIZE + len(key)
+            self.__index[key.decode()] = (value_offset, self.__end + len(record) - value_offset, len(record))
+            self.__live += len(record)
+        self.__end += len(record)
+        return self.__end - self.__live > self.__max_size * self.__compact_ratio
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__index.get(key)
+            if entry is None:
+                return default
+            return ujson.loads(self.__read_value(entry))
+
+    def put(self, key, value):
+        key = key.encode()
+        record = self.__record(key, ujson.dumps(value).encode())
+        with self.__lock:
+            compact = self.__append(key, record, False)
+            self.__stats['puts'] += 1
+        if compact:
+            self.__compact_thread.start()
+
+    def delete(self, key):
+        with self.__lock:
+            if key not in self.__index:
+                return False
+            compact = self.__append(key.encode(), self.__record(key.encode(), b'', self.FLAG_DELETED), True)
+            self.__stats['deletes'] += 1
+        if compact:
+            self.__compact_thread.start()
+        return True
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def __len__(self):
+        return len(self.__index)
+
+    def keys(self):
+        return list(self.__index.keys())
+
+    def stats(self):
+        with self.__lock:
+            rv = dict(self.__stats)
+            rv['size'] = self.__end
+            rv['live'] = self.__live
+        return rv
+
+    def compact(self):
+        with self.__lock:
+            self.__compact()
+
+    def __compact(self):
+        """rewrite live records to a temp file and rename it over the store."""
+        tmp = self.__path + '.tmp'
+        index = {}
+        offset = 0
+        with open(tmp, 'wb') as f:
+            for key, entry in self.__index.items():
+                raw_key = key.encode()
+                record = self.__record(raw_key, self.__read_value(entry))
+                f.write(record)
+                index[key] = (offset + self.HEADER_SIZE + len(raw_key), entry[1], len(record))
+                offset += len(record)
+        self.__fp.close()
+        try:
+            uos.rename(tmp, self.__path)
+        except OSError:
+            uos.remove(self.__path)
+            uos.rename(tmp, self.__path)
+        self.__fp = open(self.__path, 'r+b')
+        self.__index = index
+        self.__live = self.__end = offset
+        self.__stats['compactions'] += 1
+
+    def close(self):
+        with self.__lock:
+            if self.__fp is not None:
+                self.__fp.close()
+                self.__fp = None
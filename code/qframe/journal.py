@@ -0,0 +1,209 @@
+import uos
+import ql_fs
+import utime
+import ubinascii
+import ustruct as struct
+from .threading import Lock
+from .logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Journal(object):
+    """append-only store-and-forward journal on flash.
+
+    records are appended to numbered segment files under `path`, each record is len(2B) crc32(4B) payload.
+    a new segment is started when the current one would exceed `segment_size`, and at most `max_segments`
+    segments are kept, the oldest one is evicted first. replayed segments are removed, the replay cursor is
+    persisted so records survive reboots (delivery is at-least-once).
+    """
+    HEADER = '>HI'
+    HEADER_SIZE = 6
+
+    def __init__(self, path='/usr/journal', segment_size=16384, max_segments=8, flush_records=16):
+        if max_segments < 1:
+            raise ValueError('max_segments must be greater than 0.')
+        self.__path = path.rstrip('/')
+        self.__segment_size = segment_size
+        self.__max_segments = max_segments
+        self.__flush_records = flush_records
+        self.__segments = []
+        self.__writer = None
+        self.__writer_index = None
+        self.__write_size = 0
+        self.__unflushed = 0
+        self.__reader = None
+        self.__reader_index = None
+        self.__cursor = (None, 0)
+        self.__lock = Lock()
+        self.__stats = {'appended': 0, 'replayed': 0, 'evicted': 0}
+        self.__load()
+
+    def __str__(self):
+        return '<Journal {}>'.format(self.__path)
+
+    def __segment_path(self, index):
+        return '{}/{:08d}.seg'.format(self.__path, index)
+
+    def __cursor_path(self):
+        return '{}/cursor'.format(self.__path)
+
+    def __load(self):
+        if not ql_fs.path_exists(self.__path):
+            ql_fs.mkdirs(self.__path)
+        self.__segments = sorted(int(name[:-4]) for name in uos.listdir(self.__path) if name.endswith('.seg'))
+        cursor = (None, 0)
+        if ql_fs.path_exists(self.__cursor_path()):
+            try:
+                with open(self.__cursor_path(), 'r') as f:
+                    index, offset = f.read().split()
+                cursor = (int(index), int(offset))
+            except Exception as e:
+                logger.warn('{} bad cursor file: {}'.format(self, e))
+        if cursor[0] not in self.__segments:
+            cursor = (self.__segments[0], 0) if self.__segments else (None, 0)
+        self.__cursor = cursor
+
+    def __save_cursor(self):
+        with open(self.__cursor_path(), 'w') as f:
+            f.write('{} {}'.format(*self.__cursor))
+
+    def stats(self):
+        rv = dict(self.__stats)
+        rv['segments'] = len(self.__segments)
+        return rv
+
+    def pending(self):
+        if not self.__segments:
+            return False
+        return self.__cursor != (self.__writer_index, self.__write_size)
+
+    def __close_reader(self):
+        if self.__reader is not None:
+            self.__reader.close()
+            self.__reader = None
+            self.__reader_index = None
+
+    def __remove_segment(self, index):
+        if self.__reader_index == index:
+            self.__close_reader()
+        self.__segments.remove(index)
+        try:
+            uos.remove(self.__segment_path(index))
+        except Exception as e:
+            logger.warn('{} remove segment {} error: {}'.format(self, index, e))
+        if self.__cursor[0] == index:
+            self.__cursor = (self.__segments[0], 0) if self.__segments else (None, 0)
+
+    def __rotate(self):
+        if self.__writer is not None:
+            self.__writer.close()
+        # always start a fresh segment, never append behind a possibly torn tail.
+        index = self.__segments[-1] + 1 if self.__segments else 0
+        self.__writer = open(self.__segment_path(index), 'wb')
+        self.__writer_index = index
+        self.__write_size = 0
+        self.__unflushed = 0
+        self.__segments.append(index)
+        if self.__cursor[0] is None:
+            self.__cursor = (index, 0)
+        while len(self.__segments) > self.__max_segments:
+            oldest = self.__segments[0]
+            logger.warn('{} flash budget exceeded, evict segment {}'.format(self, oldest))
+            self.__remove_segment(oldest)
+            self.__stats['evicted'] += 1
+
+    def append(self, data):
+        size = self.HEADER_SIZE + len(data)
+        with self.__lock:
+            if self.__writer is None or (self.__write_size and self.__write_size + size > self.__segment_size):
+                self.__rotate()
+            self.__writer.write(struct.pack(self.HEADER, len(data), ubinascii.crc32(data)) + data)
+            self.__write_size += size
+            self.__unflushed += 1
+            self.__stats['appended'] += 1
+            if self.__unflushed >= self.__flush_records:
+                self.__writer.flush()
+                self.__unflushed = 0
+
+    def flush(self):
+        with self.__lock:
+            if self.__writer is not None and self.__unflushed:
+                self.__writer.flush()
+                self.__unflushed = 0
+
+    def __next_record(self):
+        """return (data, cursor after data) of the oldest record not replayed, or None."""
+        while self.__segments:
+            index, offset = self.__cursor
+            if index == self.__writer_index:
+                if offset >= self.__write_size:
+                    return None
+                if self.__unflushed:
+                    self.__writer.flush()
+                    self.__unflushed = 0
+            if self.__reader_index != index:
+                self.__close_reader()
+                self.__reader = open(self.__segment_path(index), 'rb')
+                self.__reader_index = index
+            self.__reader.seek(offset)
+            header = self.__reader.read(self.HEADER_SIZE)
+            if header and len(header) == self.HEADER_SIZE:
+                length, crc = struct.unpack(self.HEADER, header)
+                data = self.__reader.read(length)
+                if len(data) == length and ubinascii.crc32(data) == crc:
+                    return data, (index, offset + self.HEADER_SIZE + length)
+                logger.warn('{} torn record in segment {} at {}'.format(self, index, offset))
+            if index == self.__writer_index:
+                return None
+            # segment fully replayed, truncate it.
+            self.__remove_segment(index)
+        return None
+
+    def replay(self, send, rate=None):
+        """send journaled records in order, stop at the first failure.
+
+        @send: function taking the payload, returns True on success.
+        @rate: max records per second, None for no limit.
+        @return: number of records replayed.
+        """
+        interval = 1000 // rate if rate else 0
+        count = 0
+        try:
+            while True:
+                with self.__lock:
+                    record = self.__next_record()
+                if record is None:
+                    break
+                data, cursor = record
+                if not send(data):
+                    break
+                with self.__lock:
+                    self.__cursor = cursor
+                    self.__stats['replayed'] += 1
+                count += 1
+                if count % self.__flush_records == 0:
+                    self.__save_cursor()
+                if interval:
+                    utime.sleep_ms(interval)
+        finally:
+            if count:
+                with self.__lock:
+                    self.__truncate_replayed()
+                logger.info('{} replayed {} records'.format(self, count))
+        return count
+
+    def __truncate_replayed(self):
+        if self.__writer is not None and self.__cursor == (self.__writer_index, self.__write_size):
+            # caught up, drop the current segment too so the next append starts a fresh one.
+            self.__writer.close()
+            self.__writer = None
+            self.__remove_segment(self.__writer_index)
+            self.__writer_index = None
+            self.__write_size = 0
+            self.__unflushed = 0
+        if self.__segments:
+            self.__save_cursor()
+        elif ql_fs.path_exists(self.__cursor_path()):
+            uos.remove(self.__cursor_path())
@@ -1,11 +1,22 @@
 import uos
+import utime
 import uzlib
 import ql_fs
+import uhashlib
+import ubinascii
 import request
 import fota as BaseFota
 import app_fota as BaseAppFota
 from app_fota_download import update_download_stat
-from .threading import Event
+from .threading import Event, Queue, Thread
+from .logging import getLogger
+try:
+    from uio import IOBase
+except ImportError:
+    IOBase = object
+
+
+logger = getLogger(__name__)
 
 
 class Fota(object):
@@ -20,6 +31,7 @@ class Fota(object):
         self.__finished = Event()
         self.__success = False
         self.__progress_callback = progress_callback
+        self.speed = 0
 
     def __download_callback(self, args):
         if args[0] in (0, 1, 2):
@@ -61,25 +73,63 @@ class Fota(object):
         """
         return self.fota.httpDownload(url1=url1, url2=url2) == 0
 
-    def local_upgrade(self, path):
+    @staticmethod
+    def __read_ahead(f, free, full, stop):
+        """读线程, 在两个缓冲区间交替读取, 写线程写入一块时下一块已经读好"""
+        try:
+            while True:
+                buf = free.get()
+                if stop:
+                    break
+                n = f.readinto(buf)
+                full.put((buf, n or 0))
+                if not n:
+                    break
+        except Exception as e:
+            logger.error("local upgrade read error: {}".format(e))
+            full.put((None, -1))
+        finally:
+            f.close()
+
+    def local_upgrade(self, path, chunk_size=4096):
         """
         本地升级。
 
         @path: 升级固件包本地文件路径。
+        @chunk_size: 每次读取写入的字节数, 读取和写入双缓冲并行。
         @return: (result, code), result是布尔值True表示成功，False表示失败；code是错误码，1表示升级包数据流写入失败，2表示刷新RAM缓存
         数据到flash失败，3表示校验失败。
         """
-        with open(path, 'rb') as f:
-            size = f.seek(0, 2)
-            f.seek(0, 0)
-            while True:
-                content = f.read(4096)
-                if not content:
-                    break
-                if self.fota.write(content, size) == -1:
+        f = open(path, 'rb')
+        size = f.seek(0, 2)
+        f.seek(0, 0)
+        free = Queue(max_size=2)
+        full = Queue(max_size=2)
+        free.put(bytearray(chunk_size))
+        free.put(bytearray(chunk_size))
+        stop = []
+        Thread(target=self.__read_ahead, args=(f, free, full, stop)).start()
+        start = utime.ticks_ms()
+        written = 0
+        percent = -1
+        while True:
+            buf, n = full.get()
+            if n <= 0:
+                if n < 0:
                     return False, 1
-                if self.__progress_callback:
-                    self.__progress_callback(int(f.tell() / size * 100))
+                break
+            if self.fota.write(buf if n == len(buf) else memoryview(buf)[:n], size) == -1:
+                stop.append(True)
+                free.put(buf)
+                return False, 1
+            free.put(buf)
+            written += n
+            if self.__progress_callback and written * 100 // size != percent:
+                percent = written * 100 // size
+                self.__progress_callback(percent)
+        elapsed = utime.ticks_diff(utime.ticks_ms(), start)
+        self.speed = written / 1048576 / (elapsed / 1000) if elapsed > 0 else 0
+        logger.info("local upgrade wrote {} bytes in {} ms, {:.2f} MB/s".format(written, elapsed, self.speed))
         if self.fota.flush() == -1:
             return False, 2
         if self.fota.verify() == -1:
@@ -87,21 +137,60 @@ class Fota(object):
         return True, 0
 
 
+class ResponseStream(IOBase):
+    """把`request`响应的分块内容包装成可读流, 供uzlib.DecompIO直接读取, 无需落地临时文件。"""
+
+    def __init__(self, response):
+        self.__response = response
+        self.__chunks = iter(response.content)
+        self.__buffer = b''
+
+    def __fill(self, size):
+        while len(self.__buffer) < size:
+            try:
+                self.__buffer += next(self.__chunks)
+            except StopIteration:
+                break
+
+    def read(self, size=-1):
+        if size < 0:
+            for chunk in self.__chunks:
+                self.__buffer += chunk
+            size = len(self.__buffer)
+        self.__fill(size)
+        data = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if hasattr(self.__response, 'close'):
+            self.__response.close()
+
+
 class FileDecode(object):
 
-    def __init__(self, zip_file, parent_dir="/fota/code/"):
-        self.data = b''
-        self.fp = open(zip_file, "rb")
+    def __init__(self, zip_file, parent_dir="/fota/code/", buffer_size=0x200):
+        """
+        @zip_file: tar.gz文件路径, 或可读流(如ResponseStream)。
+        @buffer_size: 解包时每次读取写入的字节数, 按512字节对齐。
+        """
+        self.fp = open(zip_file, "rb") if isinstance(zip_file, str) else zip_file
         self.fileData = None
         self.parent_dir = parent_dir
+        self.buffer_size = max(0x200, buffer_size // 0x200 * 0x200)
         self.update_file_list = []
 
     def get_update_files(self):
         return self.update_file_list
 
     def unzip(self):
-        """缓存到内存中"""
-        self.fp.seek(10)
+        """流式解压, 跳过10字节gzip头"""
+        self.fp.read(10)
         self.fileData = uzlib.DecompIO(self.fp, -15, 1)
 
     @classmethod
@@ -121,55 +210,67 @@ class FileDecode(object):
         """获取文件名称"""
         return cls._ascii_trip(file_name)
 
-    def get_data(self):
-        return self.fileData.read(0x200)
+    def get_data(self, size=0x200):
+        data = b''
+        while len(data) < size:
+            chunk = self.fileData.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def __extract(self, full_file_name, size):
+        """文件数据按512字节对齐, 收到一块写一块"""
+        padded = (size + 0x1FF) // 0x200 * 0x200
+        with open(full_file_name, "wb+") as update_file:
+            while padded:
+                want = min(self.buffer_size, padded)
+                data = self.get_data(want)
+                if len(data) < want:
+                    raise ValueError('tar stream ended early.')
+                padded -= want
+                if size > 0:
+                    update_file.write(data[:size])
+                    size -= want
 
     def unpack(self):
         try:
-            folder_list = set()
-            self.data = self.get_data()
             while True:
-                if not self.data:
+                header = self.get_data()
+                if len(header) < 0x200:
+                    break
+                file_name = self.get_file_name(header[:100])
+                if not file_name:
+                    # 结尾的全0块
                     break
-                size = self.file_size(self.data[124:135])
-                file_name = self.get_file_name(self.data[:100])
+                size = self.file_size(header[124:135])
                 full_file_name = self.parent_dir + file_name
-
                 if not size:
-                    if len(full_file_name):
-                        ql_fs.mkdirs(full_file_name)
-                        if full_file_name not in folder_list and full_file_name != self.parent_dir:
-                            folder_list.add(full_file_name)
-                    else:
-                        return
-                    self.data = self.get_data()
+                    ql_fs.mkdirs(full_file_name)
                 else:
-                    self.data = self.get_data()
-                    update_file = open(full_file_name, "wb+")
-                    total_size = size
-                    while True:
-                        size -= 0x200
-                        if size <= 0:
-                            update_file.write(self.data[:size + 512])
-                            break
-                        else:
-                            update_file.write(self.data)
-                        self.data = self.get_data()
-                    self.data = self.get_data()
-                    update_file.close()
-                    self.update_file_list.append({"file_name": file_name, "size": total_size})
+                    self.__extract(full_file_name, size)
+                    self.update_file_list.append({"file_name": file_name, "size": size})
         except Exception as e:
-            self.fp.close()
             return False
-        else:
+        finally:
             self.fp.close()
-            return True
+        return True
 
 
 class AppFota(object):
 
-    def __init__(self):
+    def __init__(self, progress_callback=None, chunk_size=4096, max_retries=5, save_every=16):
+        """
+        @progress_callback: 下载进度回调, 参数为(进度百分比0~100, 吞吐量bytes/s)。
+        @chunk_size: 断点续传的块大小, 每块校验并落盘后才推进断点。
+        @max_retries: 连接中断后以Range请求续传的最大次数。
+        @save_every: 每落盘多少块保存一次断点, 连接中断时也会保存, 掉电最多重新下载这么多块。
+        """
         self.fota = BaseAppFota.new()
+        self.__progress_callback = progress_callback
+        self.__chunk_size = chunk_size
+        self.__max_retries = max_retries
+        self.__save_every = save_every
 
     def set_update_flag(self):
         """设置升级标志（当且仅当升级文件下载成功后，且设置了升级标志，重启后才会触发升级，否则不升级。）"""
@@ -193,17 +294,115 @@ class AppFota(object):
         return self.fota.bulk_download(info)
 
     @staticmethod
-    def __download_file_from_server(url, path):
-        response = request.get(url)
-        if response.status_code not in (200, 206):
-            return False
-        with open(path, 'wb') as f:
-            for c in response.content:
-                f.write(c)
+    def __state_path(path):
+        return path + '.part'
+
+    def __load_download_state(self, url, path):
+        """
+        读取断点, 并按记录的每块crc32复核已落盘数据, 从第一个损坏的块重新下载
+        @return: (offset, crcs)
+        """
+        state_path = self.__state_path(path)
+        if not ql_fs.path_exists(state_path) or not ql_fs.path_exists(path):
+            return 0, []
+        try:
+            state = ql_fs.read_json(state_path)
+            if state['url'] != url or state['chunk_size'] != self.__chunk_size:
+                return 0, []
+            crcs = state['crcs']
+        except Exception:
+            return 0, []
+        with open(path, 'rb') as f:
+            for index, crc in enumerate(crcs):
+                if ubinascii.crc32(f.read(self.__chunk_size)) != crc:
+                    crcs = crcs[:index]
+                    break
+        return len(crcs) * self.__chunk_size, crcs
+
+    def __save_download_state(self, url, path, crcs):
+        ql_fs.touch(self.__state_path(path), {'url': url, 'chunk_size': self.__chunk_size, 'crcs': crcs})
+
+    @staticmethod
+    def __total_size(response, offset):
+        headers = getattr(response, 'headers', None) or {}
+        for key, value in headers.items():
+            key = key.lower()
+            if key == 'content-range' and '/' in value:
+                total = value.rsplit('/', 1)[1].strip()
+                if total != '*':
+                    return int(total)
+            elif key == 'content-length':
+                return offset + int(value)
+        return None
+
+    def __report(self, offset, total, start, received):
+        if not self.__progress_callback or not total:
+            return
+        elapsed = utime.ticks_diff(utime.ticks_ms(), start)
+        self.__progress_callback(int(offset * 100 / total), received * 1000 // elapsed if elapsed > 0 else 0)
+
+    def __download_file_from_server(self, url, path, checksums=None):
+        """
+        断点续传下载, 断点和每块crc32保存在`path`.part中, 连接中断后以Range请求从断点继续
+
+        @checksums: 可选, 服务器提供的每块crc32列表, 每块到达时校验, 不一致则从该块重新请求
+        @return: True表示下载完成
+        """
+        offset, crcs = self.__load_download_state(url, path)
+        saved = len(crcs)
+        start = utime.ticks_ms()
+        received = 0
+        for _ in range(self.__max_retries + 1):
+            try:
+                response = request.get(url, headers={'Range': 'bytes={}-'.format(offset)} if offset else None)
+                if response.status_code == 200:
+                    # 服务器不支持Range, 从头下载
+                    offset, crcs, saved = 0, [], 0
+                elif response.status_code != 206:
+                    return False
+                total = self.__total_size(response, offset)
+                with open(path, 'r+b' if offset else 'wb') as f:
+                    f.seek(offset)
+                    chunk = b''
+                    for c in response.content:
+                        chunk += c
+                        received += len(c)
+                        while len(chunk) >= self.__chunk_size or (total and offset + len(chunk) >= total and chunk):
+                            data, chunk = chunk[:self.__chunk_size], chunk[self.__chunk_size:]
+                            crc = ubinascii.crc32(data)
+                            if checksums is not None and (len(crcs) >= len(checksums) or checksums[len(crcs)] != crc):
+                                raise ValueError('chunk {} checksum mismatch.'.format(len(crcs)))
+                            f.write(data)
+                            f.flush()
+                            offset += len(data)
+                            crcs.append(crc)
+                            if len(crcs) - saved >= self.__save_every:
+                                # 每次保存都重写整个crc列表, 按块数节流
+                                self.__save_download_state(url, path, crcs)
+                                saved = len(crcs)
+                            self.__report(offset, total, start, received)
+                    if chunk and total is None:
+                        # 长度未知时最后一块
+                        f.write(chunk)
+                        offset += len(chunk)
+                    # 长度已知而响应提前结束时丢弃不完整的块, 从最后一个完整块续传, 断点保持在块边界上
+                if total is None or offset >= total:
+                    # 整个文件在一块之内时没有写过断点文件
+                    if ql_fs.path_exists(self.__state_path(path)):
+                        uos.remove(self.__state_path(path))
+                    return True
+            except Exception as e:
+                # 连接中断或块校验失败, 稍后从断点续传
+                logger.warn("download {} interrupted at {}: {}".format(url, offset, e))
+            if len(crcs) != saved:
+                self.__save_download_state(url, path, crcs)
+                saved = len(crcs)
+            utime.sleep(1)
+        return False
 
     @staticmethod
-    def __decode_file_to_updater_dir(path, updater_dir):
-        fd = FileDecode(path, parent_dir=updater_dir)
+    def __decode_file_to_updater_dir(path, updater_dir, buffer_size=0x200):
+        fd = FileDecode(path, parent_dir=updater_dir, buffer_size=buffer_size)
         ql_fs.mkdirs(updater_dir)
         fd.unzip()
         if fd.unpack():
@@ -213,14 +412,82 @@ class AppFota(object):
         else:
             return False
 
-    def download_tar(self, url, path="/code/temp.tar.gz"):
-        """通过压缩文件下载升级。"""
-        self.__download_file_from_server(url, path)
-        if self.__decode_file_to_updater_dir(
-            path,
-            self.fota.app_fota_pkg_mount.fota_dir + '/code/.updater/code/'
-        ):
+    def download_tar(self, url, path="/code/temp.tar.gz", stream=False, buffer_size=0x200):
+        """通过压缩文件下载升级。
+
+        @stream: True表示边下载边解压解包, 不写临时压缩文件(忽略path), flash写入减半且不受临时文件大小限制。
+        @buffer_size: 解包时每次读取写入的字节数, 按512字节对齐。
+        """
+        updater_dir = self.fota.app_fota_pkg_mount.fota_dir + '/code/.updater/code/'
+        if stream:
+            response = request.get(url)
+            if response.status_code not in (200, 206):
+                return False
+            return self.__decode_file_to_updater_dir(ResponseStream(response), updater_dir, buffer_size)
+        if not self.__download_file_from_server(url, path):
+            return False
+        if self.__decode_file_to_updater_dir(path, updater_dir, buffer_size):
             uos.remove(path)
             return True
         else:
             return False
+
+    @staticmethod
+    def __file_hash(path):
+        h = uhashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(4096)
+                if not data:
+                    break
+                h.update(data)
+        return ubinascii.hexlify(h.digest()).decode()
+
+    def __local_hashes(self, file_names, index_path):
+        """
+        本地文件sha256, 缓存在index_path中, 文件大小和修改时间不变时直接使用缓存
+        """
+        index = ql_fs.read_json(index_path) if ql_fs.path_exists(index_path) else None
+        index = index or {}
+        hashes = {}
+        for file_name in file_names:
+            if not ql_fs.path_exists(file_name):
+                continue
+            stat = uos.stat(file_name)
+            cached = index.get(file_name)
+            if cached and cached['size'] == stat[6] and cached['mtime'] == stat[8]:
+                hashes[file_name] = cached['sha256']
+                continue
+            hashes[file_name] = self.__file_hash(file_name)
+            index[file_name] = {'size': stat[6], 'mtime': stat[8], 'sha256': hashes[file_name]}
+        ql_fs.touch(index_path, index)
+        return hashes
+
+    def __updater_path(self, file_name):
+        # 与download_tar一致, /code/x暂存到<fota_dir>/code/.updater/code/x
+        top = file_name.split('/')[1]
+        return '{}/{}/.updater{}'.format(self.fota.app_fota_pkg_mount.fota_dir, top, file_name)
+
+    def download_manifest(self, url, index_path='/usr/.ota_index.json'):
+        """清单差分升级, 只下载与本地sha256不一致的文件。
+
+        @url: 清单下载链接, 内容为{"files": [{"file_name": "/usr/a.py", "url": "...", "sha256": "..."}]}。
+        @index_path: 本地文件哈希缓存。
+        @return: 下载的文件列表(无变化时为空列表), 失败返回None。
+        """
+        response = request.get(url)
+        if response.status_code != 200:
+            return None
+        files = response.json()['files']
+        hashes = self.__local_hashes([item['file_name'] for item in files], index_path)
+        changed = [item for item in files if hashes.get(item['file_name']) != item['sha256']]
+        for item in changed:
+            path = self.__updater_path(item['file_name'])
+            ql_fs.mkdirs(path[:path.rfind('/')])
+            if not self.__download_file_from_server(item['url'], path):
+                return None
+            if self.__file_hash(path) != item['sha256']:
+                uos.remove(path)
+                return None
+            update_download_stat(item['url'], item['file_name'], uos.stat(path)[6])
+        return [item['file_name'] for item in changed]
@@ -1,3 +1,4 @@
+import utime
 import usocket
 from .logging import getLogger
 from .threading import Lock
@@ -5,6 +6,88 @@ from .threading import Lock
 logger = getLogger(__name__)
 
 
+class DNSCache(object):
+    """process-wide `getaddrinfo` cache keyed by (host, port).
+
+    successful lookups are kept for `ttl` seconds, failed lookups for `negative_ttl` seconds. when a lookup fails
+    the last good address of the same key is returned instead, so a dns outage never hides a known server.
+    """
+    ttl = 300
+    negative_ttl = 10
+    __entries__ = {}
+    __metrics__ = {'lookups': 0, 'hits': 0, 'failures': 0, 'fallbacks': 0, 'last_ms': 0, 'max_ms': 0, 'total_ms': 0}
+    __lock__ = Lock()
+
+    @classmethod
+    def configure(cls, ttl=None, negative_ttl=None):
+        with cls.__lock__:
+            if ttl is not None:
+                cls.ttl = ttl
+            if negative_ttl is not None:
+                cls.negative_ttl = negative_ttl
+
+    @classmethod
+    def resolve(cls, host, port):
+        key = (host, port)
+        now = utime.ticks_ms()
+        with cls.__lock__:
+            entry = cls.__entries__.setdefault(key, {'addr': None, 'expires': now, 'failed_until': None})
+            if entry['addr'] and utime.ticks_diff(entry['expires'], now) > 0:
+                cls.__metrics__['hits'] += 1
+                return entry['addr']
+            if entry['failed_until'] is not None and utime.ticks_diff(entry['failed_until'], now) > 0:
+                # negative cached, do not stall on dns again.
+                return cls.__fallback(key, entry)
+
+        start = utime.ticks_ms()
+        try:
+            rv = usocket.getaddrinfo(host, port)
+        except Exception as e:
+            logger.warn('getaddrinfo {} error: {}'.format(key, e))
+            rv = None
+        cost = utime.ticks_diff(utime.ticks_ms(), start)
+
+        with cls.__lock__:
+            metrics = cls.__metrics__
+            metrics['lookups'] += 1
+            metrics['last_ms'] = cost
+            metrics['total_ms'] += cost
+            if cost > metrics['max_ms']:
+                metrics['max_ms'] = cost
+            now = utime.ticks_ms()
+            if rv:
+                entry['addr'] = rv
+                entry['expires'] = utime.ticks_add(now, cls.ttl * 1000)
+                entry['failed_until'] = None
+                return rv
+            metrics['failures'] += 1
+            entry['failed_until'] = utime.ticks_add(now, cls.negative_ttl * 1000)
+            return cls.__fallback(key, entry)
+
+    @classmethod
+    def __fallback(cls, key, entry):
+        if entry['addr'] is None:
+            raise ValueError('DNS detect error')
+        cls.__metrics__['fallbacks'] += 1
+        logger.warn('dns resolve {} failed, use last known address.'.format(key))
+        return entry['addr']
+
+    @classmethod
+    def invalidate(cls, host=None, port=None):
+        with cls.__lock__:
+            if host is None:
+                cls.__entries__.clear()
+            else:
+                cls.__entries__.pop((host, port), None)
+
+    @classmethod
+    def metrics(cls):
+        with cls.__lock__:
+            rv = dict(cls.__metrics__)
+        rv['avg_ms'] = rv['total_ms'] // rv['lookups'] if rv['lookups'] else 0
+        return rv
+
+
 class TcpSocket(object):
     socket_type = usocket.SOCK_STREAM
 
@@ -30,10 +113,18 @@ class TcpSocket(object):
             raise ValueError('Socket Unbound Error')
         return self.__sock
 
+    @classmethod
+    def from_accepted(cls, sock, address, timeout=None):
+        """wrap a socket returned by `accept()` of a listening socket."""
+        self = cls(address[0], address[1], timeout=timeout)
+        self.__ip = address[0]
+        self.__sock = sock
+        if timeout and timeout > 0:
+            sock.settimeout(timeout)
+        return self
+
     def __init_args(self):
-        rv = usocket.getaddrinfo(self.__host, self.__port)
-        if not rv:
-            raise ValueError('DNS detect error')
+        rv = DNSCache.resolve(self.__host, self.__port)
         self.__family = rv[0][0]
         self.__domain = rv[0][3]
         self.__ip, self.__port = rv[0][4]
@@ -65,6 +156,19 @@ class TcpSocket(object):
             else:
                 raise e
 
+    def read_into(self, buf, size=None):
+        """read data into a caller-owned buffer without allocating, return the number of bytes read."""
+        try:
+            if size is None:
+                return self.sock.readinto(buf)
+            return self.sock.readinto(buf, size)
+        except Exception as e:
+            if isinstance(e, OSError) and e.args[0] == 110:
+                # read timeout.
+                raise self.TimeoutError(str(self))
+            else:
+                raise e
+
     @property
     def status_code(self):
         if self.__sock is None:
@@ -72,6 +176,41 @@ class TcpSocket(object):
         return self.__sock.getsocketsta()
 
 
+class TcpServerSocket(object):
+
+    def __init__(self, host='0.0.0.0', port=10026, backlog=4, timeout=None):
+        self.__host = host
+        self.__port = port
+        self.__backlog = backlog
+        self.__timeout = timeout
+        self.__sock = None
+
+    def __str__(self):
+        return '{}(host=\"{}\",port={})'.format(type(self).__name__, self.__host, self.__port)
+
+    @property
+    def sock(self):
+        if self.__sock is None:
+            raise ValueError('Socket Unbound Error')
+        return self.__sock
+
+    def listen(self):
+        self.__sock = usocket.socket(usocket.AF_INET, usocket.SOCK_STREAM)
+        self.__sock.setsockopt(usocket.SOL_SOCKET, usocket.SO_REUSEADDR, 1)
+        self.__sock.bind((self.__host, self.__port))
+        self.__sock.listen(self.__backlog)
+
+    def accept(self):
+        """block until a peer connects, return a connected `TcpSocket`."""
+        sock, address = self.sock.accept()
+        return TcpSocket.from_accepted(sock, address, timeout=self.__timeout)
+
+    def close(self):
+        if self.__sock:
+            self.__sock.close()
+            self.__sock = None
+
+
 class UdpSocket(TcpSocket):
     socket_type = usocket.SOCK_DGRAM
 
@@ -104,3 +243,11 @@ class UdpSocket(TcpSocket):
             if not isinstance(e, self.TimeoutError):
                 self.status_code = 98
             raise e
+
+    def read_into(self, buf, size=None):
+        try:
+            return super().read_into(buf, size=size)
+        except Exception as e:
+            if not isinstance(e, self.TimeoutError):
+                self.status_code = 98
+            raise e
@@ -0,0 +1,247 @@
+"""CPython stand-ins for the QuecPython modules used by `code/`, so the framework can be tested on loopback."""
+
+import io
+import os
+import sys
+import json
+import time
+import types
+import zlib
+import random
+import struct
+import socket as _socket
+import hashlib
+import binascii
+import threading
+import traceback
+import _thread as _real_thread
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code')
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+# utime
+_module(
+    'utime',
+    time=time.time,
+    localtime=time.localtime,
+    mktime=time.mktime,
+    sleep=time.sleep,
+    sleep_ms=lambda ms: time.sleep(ms / 1000),
+    ticks_ms=lambda: int(time.monotonic() * 1000),
+    ticks_add=lambda ticks, delta: ticks + delta,
+    ticks_diff=lambda a, b: a - b,
+)
+
+# usys
+_module(
+    'usys',
+    stdout=sys.stdout,
+    stderr=sys.stderr,
+    print_exception=lambda e, *args: traceback.print_exception(type(e), e, e.__traceback__),
+)
+
+sys.modules.setdefault('ustruct', struct)
+sys.modules.setdefault('ujson', json)
+sys.modules.setdefault('uos', os)
+sys.modules.setdefault('uio', io)
+sys.modules.setdefault('urandom', random)
+sys.modules.setdefault('uhashlib', hashlib)
+_module('ubinascii', crc32=binascii.crc32, hexlify=binascii.hexlify, unhexlify=binascii.unhexlify)
+_module('uzlib', decompress=zlib.decompress)
+
+# _thread with the QuecPython extensions
+_running = set()
+
+
+def _start_new_thread(func, args, kwargs=None):
+    started = threading.Event()
+    ident = []
+
+    def run():
+        ident.append(_real_thread.get_ident())
+        _running.add(ident[0])
+        started.set()
+        try:
+            func(*args, **(kwargs or {}))
+        finally:
+            _running.discard(ident[0])
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return ident[0]
+
+
+_module(
+    '_thread',
+    allocate_lock=_real_thread.allocate_lock,
+    get_ident=_real_thread.get_ident,
+    start_new_thread=_start_new_thread,
+    threadIsRunning=lambda ident: ident in _running,
+    # threads cannot be killed in CPython, a stopped thread is just forgotten
+    stop_thread=lambda ident: _running.discard(ident),
+)
+
+
+class osTimer(object):
+
+    def __init__(self):
+        self.__timer = None
+
+    def start(self, period, repeat, callback):
+        self.stop()
+        self.__timer = threading.Timer(period / 1000, callback, args=(None,))
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def stop(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+
+# `import osTimer` then `osTimer()`, the module itself is the timer class on QuecPython
+sys.modules['osTimer'] = osTimer
+
+
+def _touch(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+_module(
+    'ql_fs',
+    path_exists=os.path.exists,
+    mkdirs=lambda path: os.makedirs(path, exist_ok=True),
+    read_json=_read_json,
+    touch=_touch,
+)
+
+for _name in ('sms', 'sim', 'net', 'checkNet', 'dataCall', 'modem', 'request', 'fota', 'app_fota'):
+    _module(_name)
+_module('misc', Power=object)
+_module('machine', UART=object, Pin=object)
+_module('app_fota_download', update_download_stat=lambda *args: None)
+
+
+# usocket on top of real loopback sockets
+class _UsocketModule(types.ModuleType):
+    AF_INET = _socket.AF_INET
+    SOCK_STREAM = _socket.SOCK_STREAM
+    SOCK_DGRAM = _socket.SOCK_DGRAM
+    SOL_SOCKET = _socket.SOL_SOCKET
+    SO_REUSEADDR = _socket.SO_REUSEADDR
+    TCP_KEEPALIVE = -1
+
+    # remote address -> local address, lets two udp peers reach each other on fixed ports
+    udp_bindings = {}
+    # optional function(sock, data), returning False drops the datagram/segment on the wire
+    send_filter = None
+    # payload bytes and send calls on the wire per socket type
+    wire_bytes = {_socket.SOCK_STREAM: 0, _socket.SOCK_DGRAM: 0}
+    wire_packets = {_socket.SOCK_STREAM: 0, _socket.SOCK_DGRAM: 0}
+
+    @staticmethod
+    def getaddrinfo(host, port):
+        return _socket.getaddrinfo(host, port, _socket.AF_INET)[:1]
+
+    class socket(object):
+
+        def __init__(self, family=_socket.AF_INET, type=_socket.SOCK_STREAM, _sock=None):
+            self._type = type
+            self._sock = _sock or _socket.socket(family, type)
+            self._connected = _sock is not None
+
+        def __getattr__(self, item):
+            return getattr(self._sock, item)
+
+        def connect(self, address):
+            local = usocket.udp_bindings.get(address)
+            if self._type == _socket.SOCK_DGRAM and local is not None:
+                self._sock.bind(local)
+            self._sock.connect(address)
+            self._connected = True
+
+        def setsockopt(self, level, option, value):
+            if option != usocket.TCP_KEEPALIVE:
+                self._sock.setsockopt(level, option, value)
+
+        def accept(self):
+            sock, address = self._sock.accept()
+            return type(self)(type=self._type, _sock=sock), address
+
+        def send(self, data):
+            if usocket.send_filter is not None and usocket.send_filter(self, bytes(data)) is False:
+                return len(data)
+            self._sock.sendall(data)
+            usocket.wire_bytes[self._type] += len(data)
+            usocket.wire_packets[self._type] += 1
+            return len(data)
+
+        def __timeout(self, func, *args):
+            try:
+                return func(*args)
+            except _socket.timeout:
+                raise OSError(110)
+
+        def recv(self, size):
+            return self.__timeout(self._sock.recv, size)
+
+        def readinto(self, buf, size=0):
+            return self.__timeout(self._sock.recv_into, buf, size)
+
+        def getsocketsta(self):
+            return 4 if self._connected else 0
+
+        def close(self):
+            self._connected = False
+            try:
+                self._sock.shutdown(_socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+
+
+usocket = _UsocketModule('usocket')
+sys.modules['usocket'] = usocket
+
+# the device runs the code from /usr, modules import each other as `usr.xxx`
+_module('usr').__path__ = [CODE_DIR]
+
+
+class App(object):
+    """minimal application: config dict plus extensions, extensions are reachable as attributes like on `Application`."""
+
+    def __init__(self, **config):
+        self.config = config
+        self.extensions = {}
+
+    def __getattr__(self, item):
+        try:
+            return self.__dict__['extensions'][item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def append_extension(self, extension):
+        self.extensions[extension.name] = extension
+
+
+def wait(predicate, timeout=5):
+    """poll `predicate` until it is true or `timeout` seconds elapse, return the last result."""
+    end = time.time() + timeout
+    while not predicate():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
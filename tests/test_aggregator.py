@@ -0,0 +1,27 @@
+from conftest import App
+from usr.qframe.builtins.aggregator import Aggregator
+
+
+class Collector(Aggregator):
+
+    def __init__(self, name, app=None):
+        self.batches = []
+        super().__init__(name, app=app)
+
+    def flush_callback(self, batch):
+        self.batches.append(Aggregator.unpack(batch))
+
+
+def test_batch_never_exceeds_max_bytes():
+    aggregator = Collector('aggregator', app=App(UPLINK_BATCH={'max_delay': 10000, 'max_bytes': 100}))
+    aggregator.put(b'a' * 60)
+    # 62 + 42 bytes would exceed the budget, the pending batch goes out alone
+    aggregator.put(b'b' * 40)
+    assert aggregator.batches == [[b'a' * 60]]
+    aggregator.put(b'c' * 56)
+    assert aggregator.batches == [[b'a' * 60], [b'b' * 40, b'c' * 56]]
+    # a record larger than the budget is sent on its own
+    aggregator.put(b'd' * 200)
+    assert aggregator.batches[-1] == [b'd' * 200]
+    aggregator.flush()
+    assert len(aggregator.batches) == 3
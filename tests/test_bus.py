@@ -0,0 +1,37 @@
+from conftest import App, wait
+from usr.constant import COSEM
+from usr.protocol import RFC1662Protocol, TransactionManager
+from usr.qframe.builtins.bus import MeterBus
+
+
+class RecordingBus(MeterBus):
+
+    def __init__(self, name, app=None):
+        self.written = []
+        super().__init__(name, app=app)
+
+    def write_callback(self, address, frames):
+        self.written.append((address, frames))
+
+
+def test_unknown_addresses_share_default_session_once_full():
+    app = App(RS485_BUS={'meters': ['0x10'], 'max_meters': 2})
+    bus = RecordingBus('bus', app=app)
+    assert bus.session(0x10).address == 0x10
+    assert bus.session(0x11).address == 0x11
+    # max_meters reached, new and missing addresses go to the default meter
+    assert bus.session(0x12).address == 0x10
+    assert bus.session(None).address == 0x10
+
+
+def test_transaction_frames_go_through_the_bus():
+    app = App(RS485_BUS={'meters': ['0x10'], 'turnaround': 1})
+    bus = RecordingBus('bus', app=app)
+    bus.load()
+    transactions = TransactionManager(app=app)
+    transactions.request(COSEM.GET, 0x8003)
+    assert wait(lambda: bus.written)
+    address, frames = bus.written[0]
+    assert address == 0x10
+    assert frames == [RFC1662Protocol.build_rfc_0x2200([COSEM.GET, 0x8003, None])]
+    assert bus.stats()[0x10]['requests'] == 1
@@ -0,0 +1,79 @@
+import socket
+import threading
+
+from conftest import App, wait
+from usr.qframe.builtins.clients import TcpClient
+
+
+class Client(TcpClient):
+
+    def __init__(self, name, app=None):
+        self.received = []
+        super().__init__(name, app=app)
+
+    def recv_callback(self, data):
+        self.received.append(bytes(data))
+
+
+class Listener(object):
+    """plain loopback server recording what every accepted connection receives."""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4)
+        self.conns = []
+        self.data = b''
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def __accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.conns.append(conn)
+            threading.Thread(target=self.__read, args=(conn, ), daemon=True).start()
+
+    def __read(self, conn):
+        while True:
+            try:
+                chunk = conn.recv(1024)
+            except OSError:
+                return
+            if not chunk:
+                return
+            self.data += chunk
+
+    def close(self):
+        # shutdown first, close alone does not send FIN while a reader thread is blocked in recv
+        for conn in self.conns:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
+def test_orderly_close_fails_over_to_standby():
+    primary, standby = Listener(), Listener()
+    client = Client('client', app=App(TCP_SERVER=[
+        {'host': '127.0.0.1', 'port': primary.port, 'timeout': 1, 'priority': 0},
+        {'host': '127.0.0.1', 'port': standby.port, 'timeout': 1, 'priority': 1},
+    ], TCP_POOL={'probe_interval': 60}))
+    client.load()
+    try:
+        # the standby is probed once, then connected as warm standby
+        assert wait(lambda: len(primary.conns) == 1 and len(standby.conns) == 2)
+        primary.close()
+        # the peer closing the connection is a failure, not an empty read
+        assert wait(lambda: str(client.sock) == str(client.pool.endpoints[1].sock))
+        assert client.received == []
+        assert client.send(b'again')
+        assert wait(lambda: standby.data == b'again')
+    finally:
+        client.disconnect()
+        standby.close()
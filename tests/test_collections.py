@@ -0,0 +1,40 @@
+import os
+import json
+
+from usr.qframe.collections import KVStore, LocalStorage, memoize
+
+
+def test_local_storage_restores_from_tmp(tmp_path):
+    path = str(tmp_path / 'dev.json')
+    # power cut after the fallback removed dev.json, before the rename
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'A': 1}, f)
+    storage = LocalStorage()
+    storage.from_json(path)
+    assert storage.get('A') == 1
+    assert os.path.exists(path) and not os.path.exists(path + '.tmp')
+
+
+def test_kv_store_recovers_from_compaction_tmp(tmp_path):
+    path = str(tmp_path / 'kv.db')
+    store = KVStore(path)
+    store.put('a', 1)
+    store.put('b', [2])
+    store.close()
+    # power cut after the fallback removed the store, before the rename
+    os.rename(path, path + '.tmp')
+    store = KVStore(path)
+    assert store.get('a') == 1 and store.get('b') == [2]
+    assert not os.path.exists(path + '.tmp')
+    store.close()
+
+
+def test_memoize_keeps_positional_and_keyword_arguments_apart():
+
+    @memoize()
+    def f(*args, **kwargs):
+        return args, kwargs
+
+    assert f(1, ('a', 2)) == ((1, ('a', 2)), {})
+    assert f(1, a=2) == ((1, ), {'a': 2})
+    assert f(1, a=2) == ((1, ), {'a': 2})
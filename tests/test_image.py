@@ -0,0 +1,130 @@
+import io
+import struct
+
+from usr.constant import COSEM, COSEM_ACK, CLASS18_IMAGE_PARAM_ID
+from usr.image import ImageTransfer, StreamImageSource
+from usr.protocol import FCSUtil, RFC1662Protocol, TransactionTimeout
+
+
+class MemoryImageSource(object):
+    seekable = True
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+
+    def read(self, offset, size):
+        return self.data[offset:offset + size]
+
+    def close(self):
+        pass
+
+
+def _meter_get(param_id, data=b''):
+    # meter initiated 0x2200 GET: param_id/2b len/1b data
+    info = struct.pack('<HB', param_id, len(data)) + data
+    frame = b'\x7e\xff\x03' + struct.pack('<H', 0x2200) + struct.pack('>HB', len(info) + 1, COSEM.GET) + info
+    frame += b'\x00\x00\x7e'
+    return RFC1662Protocol.build(frame[:-3] + struct.pack('<HB', FCSUtil.calc_crc(frame), 0x7e))
+
+
+def _reply_data(reply):
+    msg = RFC1662Protocol.build(reply)
+    assert msg.cmd() == COSEM.GET_RESP
+    raw = msg.info_raw()
+    assert raw[2] == len(raw) - 3
+    return raw[3:]
+
+
+def test_pull_replies_use_the_push_format():
+    image = bytes(range(200)) * 3
+    transfer = ImageTransfer(None, MemoryImageSource(image), 'fw-1', block_size=128, state_path='/tmp/none.json')
+    info = _reply_data(transfer.reply(_meter_get(CLASS18_IMAGE_PARAM_ID.IMAGE_TRANSFER_INITIATE)))
+    assert info == struct.pack('>IH', len(image), 128) + b'fw-1'
+    block = _reply_data(transfer.reply(_meter_get(CLASS18_IMAGE_PARAM_ID.IMAGE_BLOCK_TRANSFER, struct.pack('>I', 2))))
+    assert block == struct.pack('>I', 2) + image[256:384]
+
+
+def test_pull_of_unknown_block_fails():
+    transfer = ImageTransfer(None, MemoryImageSource(b'\x00' * 100), 'fw-1', block_size=64)
+    reply = transfer.reply(_meter_get(CLASS18_IMAGE_PARAM_ID.IMAGE_BLOCK_TRANSFER, struct.pack('>I', 5)))
+    assert RFC1662Protocol.build(reply).cmd() == COSEM.CET_ERROR_RESP
+
+
+class Reply(object):
+
+    def __init__(self, ack=COSEM_ACK.SUCCESS):
+        self.raw = struct.pack('<HBB', CLASS18_IMAGE_PARAM_ID.IMAGE_BLOCK_TRANSFER, 0x01, ack)
+
+    def info_raw(self):
+        return self.raw
+
+
+class Pending(object):
+
+    def __init__(self, reply=None, exc=None):
+        self.reply = reply
+        self.exc = exc
+
+    def result(self, timeout=None):
+        if self.exc is not None:
+            raise self.exc
+        return self.reply
+
+
+class Meter(object):
+    """fake transaction manager, `outcome(n, attempt)` returns the Pending of block n's attempt."""
+    timeout = 0.01
+
+    def __init__(self, outcome=None):
+        self.outcome = outcome or (lambda n, attempt: Pending(Reply()))
+        self.blocks = []
+
+    def set(self, param_id, data, timeout=None):
+        return Reply()
+
+    def request(self, mode, param_id, data=None, pipelined=False):
+        n = struct.unpack('>I', data[:4])[0]
+        self.blocks.append((n, pipelined))
+        return self.outcome(n, sum(1 for block, _ in self.blocks if block == n))
+
+
+def test_stream_source_is_reopened_for_a_second_pass(tmp_path):
+    image = bytes(range(256)) * 4
+    opened = []
+
+    def reopen():
+        opened.append(1)
+        return io.BytesIO(image)
+
+    meter = Meter(lambda n, attempt: Pending(Reply(COSEM_ACK.FAILED if (n, attempt) == (1, 1) else COSEM_ACK.SUCCESS)))
+    source = StreamImageSource(io.BytesIO(image), len(image), reopen=reopen)
+    transfer = ImageTransfer(meter, source, 'fw-1', block_size=256, state_path=str(tmp_path / 'state.json'))
+    assert transfer.run()
+    assert opened == [1]
+    assert [n for n, _ in meter.blocks] == [0, 1, 2, 3, 1]
+
+
+def test_stream_source_without_reopen_runs_one_pass(tmp_path):
+    image = bytes(256) * 4
+    meter = Meter(lambda n, attempt: Pending(Reply(COSEM_ACK.FAILED if n == 1 else COSEM_ACK.SUCCESS)))
+    source = StreamImageSource(io.BytesIO(image), len(image))
+    transfer = ImageTransfer(meter, source, 'fw-1', block_size=256, state_path=str(tmp_path / 'state.json'))
+    assert not transfer.run()
+    assert [n for n, _ in meter.blocks] == [0, 1, 2, 3]
+    assert transfer.progress() == (3, 4)
+
+
+def test_timeout_discards_inflight_results_and_stops_pipelining(tmp_path):
+    def outcome(n, attempt):
+        if (n, attempt) == (2, 1):
+            return Pending(exc=TransactionTimeout('block 2'))
+        return Pending(Reply())
+
+    meter = Meter(outcome)
+    source = MemoryImageSource(bytes(64) * 8)
+    transfer = ImageTransfer(meter, source, 'fw-1', block_size=64, window=4, state_path=str(tmp_path / 'state.json'))
+    assert transfer.run()
+    # blocks 3..5 were in flight when block 2 timed out, their replies may belong to block 2 and are not credited
+    assert meter.blocks[:6] == [(0, True), (1, True), (2, True), (3, True), (4, True), (5, True)]
+    assert meter.blocks[6:] == [(6, False), (7, False), (2, False), (3, False), (4, False), (5, False)]
@@ -0,0 +1,62 @@
+import os
+import binascii
+
+import app_fota
+import request
+import utime
+from usr.qframe.ota import AppFota
+
+
+class Response(object):
+
+    def __init__(self, status_code, headers, body, step=1000):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = (body[i:i + step] for i in range(0, len(body), step))
+
+
+def _server(image, cut_at=None):
+    """serve `image` honouring Range, the first response ends after `cut_at` bytes."""
+    calls = []
+
+    def get(url, headers=None):
+        offset = int(headers['Range'][6:-1]) if headers else 0
+        calls.append(offset)
+        body = image[offset:]
+        if len(calls) == 1 and cut_at is not None:
+            body = body[:cut_at]
+        return Response(206 if offset else 200, {'Content-Length': str(len(image) - offset)}, body)
+
+    return get, calls
+
+
+def _download(monkeypatch, tmp_path, get, checksums=None, save_every=16):
+    monkeypatch.setattr(app_fota, 'new', lambda: None, raising=False)
+    monkeypatch.setattr(request, 'get', get, raising=False)
+    monkeypatch.setattr(utime, 'sleep', lambda seconds: None)
+    path = str(tmp_path / 'image.bin')
+    fota = AppFota(chunk_size=4096, save_every=save_every)
+    return fota._AppFota__download_file_from_server('http://hes/image.bin', path, checksums=checksums), path
+
+
+def test_truncated_response_resumes_from_the_last_whole_chunk(monkeypatch, tmp_path):
+    image = bytes(range(256)) * 40
+    checksums = [binascii.crc32(image[i:i + 4096]) for i in range(0, len(image), 4096)]
+    get, calls = _server(image, cut_at=5000)
+    ok, path = _download(monkeypatch, tmp_path, get, checksums=checksums)
+    assert ok
+    assert calls == [0, 4096]
+    with open(path, 'rb') as f:
+        assert f.read() == image
+    assert not os.path.exists(path + '.part')
+
+
+def test_state_is_saved_every_n_chunks(monkeypatch, tmp_path):
+    image = os.urandom(4096 * 10)
+    saves = []
+    monkeypatch.setattr(AppFota, '_AppFota__save_download_state', lambda self, url, path, crcs: saves.append(len(crcs)))
+    get, _ = _server(image, cut_at=4096 * 7 + 100)
+    ok, _ = _download(monkeypatch, tmp_path, get, save_every=4)
+    assert ok
+    # after 4 chunks and when the first response ended early, the finished download needs no state
+    assert saves == [4, 7]
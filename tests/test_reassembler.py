@@ -0,0 +1,47 @@
+import time
+import struct
+
+from conftest import App, wait
+from usr.protocol import DownlinkReassembly, WrapperReassembler
+
+
+def _pdu(apdu):
+    return struct.pack('>HHHH', 0x0001, 0x0001, 0x0001, len(apdu)) + apdu
+
+
+def test_stale_partial_expires_without_next_chunk():
+    reassembler = WrapperReassembler(timeout=50)
+    pdu = _pdu(b'\xc0' * 16)
+    assert reassembler.feed(pdu[:10]) == []
+    assert reassembler.expire() is False
+    time.sleep(0.1)
+    assert reassembler.expire() is True
+    # the next complete pdu is not glued to the stale head
+    assert reassembler.feed(pdu) == [pdu]
+
+
+def test_partial_within_timeout_is_completed():
+    reassembler = WrapperReassembler(timeout=1000)
+    pdu = _pdu(b'\xc0' * 16)
+    assert reassembler.feed(pdu[:10]) == []
+    assert reassembler.expire() is False
+    assert reassembler.feed(pdu[10:]) == [pdu]
+
+
+def test_downlink_sweeps_registered_reassemblers():
+    downlink = DownlinkReassembly(app=App(DOWNLINK={'timeout': 50}))
+    downlink.load()
+    reassembler = downlink.new()
+    expired = []
+    expire = reassembler.expire
+    reassembler.expire = lambda: expired.append(expire()) or expired[-1]
+    pdu = _pdu(b'\xc0' * 16)
+    assert reassembler.feed(pdu[:10]) == []
+    # dropped by the sweeper thread, no further chunk needed
+    assert wait(lambda: True in expired, timeout=1)
+    downlink.release(reassembler)
+    # let a sweep that already took its copy of the list finish
+    time.sleep(0.1)
+    count = len(expired)
+    time.sleep(0.2)
+    assert len(expired) == count
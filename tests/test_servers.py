@@ -0,0 +1,99 @@
+import time
+import socket
+
+import pytest
+
+from conftest import App, wait
+from usr.qframe.builtins.servers import TcpServer
+
+
+class EchoServer(TcpServer):
+
+    def recv_callback(self, session, data):
+        # loop the data back as if the meter answered it
+        self.send(bytes(data))
+
+
+@pytest.fixture
+def start():
+    servers = []
+
+    def _start(max_sessions=2, lease=5):
+        server = EchoServer('server', app=App(TCP_LISTEN={
+            'host': '127.0.0.1', 'port': 0, 'backlog': 8, 'max_sessions': max_sessions, 'lease': lease
+        }))
+        server.load()
+        servers.append(server)
+        return server, server.sock.sock.getsockname()
+
+    yield _start
+    for server in servers:
+        server.close()
+
+
+def _recv_all(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_connection_count_is_bounded(start):
+    server, address = start(max_sessions=2)
+    clients = [socket.create_connection(address, timeout=5) for _ in range(2)]
+    assert wait(lambda: len(server.sessions) == 2)
+    extra = socket.create_connection(address, timeout=5)
+    # the server closes connections above max_sessions
+    assert extra.recv(1) == b''
+    assert len(server.sessions) == 2
+    clients[0].close()
+    assert wait(lambda: len(server.sessions) == 1)
+    for sock in clients[1:] + [extra]:
+        sock.close()
+
+
+def test_echo_throughput(start):
+    server, address = start(max_sessions=1)
+    client = socket.create_connection(address, timeout=5)
+    payload = bytes(range(256)) * 4
+    total = 256 * 1024
+    start = time.time()
+    received = 0
+    while received < total:
+        client.sendall(payload)
+        echoed = _recv_all(client, len(payload))
+        assert echoed == payload
+        received += len(echoed)
+    cost = time.time() - start
+    print('tcp server echo: {} KB in {:.3f}s, {:.1f} KB/s'.format(total // 1024, cost, total / 1024 / cost))
+    session = server.sessions[0]
+    assert wait(lambda: session.rx_bytes == total and session.tx_bytes == total)
+    client.close()
+
+
+def test_send_after_lease_expired_falls_back(start):
+    server, address = start(max_sessions=1, lease=1)
+    client = socket.create_connection(address, timeout=5)
+    client.sendall(b'ping')
+    assert _recv_all(client, 4) == b'ping'
+    assert server.owner is not None
+    time.sleep(1.1)
+    # unsolicited meter data must not go to a session whose lease expired
+    assert server.send(b'uplink') is None
+    assert server.owner is None
+    client.close()
+
+
+def test_close_stops_accepting_and_closes_sessions(start):
+    server, address = start(max_sessions=2)
+    client = socket.create_connection(address, timeout=5)
+    assert wait(lambda: len(server.sessions) == 1)
+    server.close()
+    assert server.sessions == []
+    assert client.recv(1) == b''
+    client.close()
+    with pytest.raises(OSError):
+        socket.create_connection(address, timeout=1)
@@ -0,0 +1,188 @@
+import time
+import socket
+import struct
+import threading
+
+import usocket
+from conftest import App, wait
+from usr.qframe.builtins.clients import TcpClient, UdpClient
+from usr.qframe.builtins.servers import TcpServer
+from usr.qframe.qsocket import DNSCache
+
+# assumed IPv4 + transport header bytes per datagram / segment, for the printed estimates only
+UDP_OVERHEAD = 28
+TCP_OVERHEAD = 40
+
+
+class Peer(UdpClient):
+
+    def __init__(self, name, app=None, echo=False):
+        self.received = []
+        self.event = threading.Event()
+        self.echo = echo
+        super().__init__(name, app=app)
+
+    def recv_callback(self, data):
+        self.received.append(bytes(data))
+        self.event.set()
+        if self.echo:
+            self.send(bytes(data))
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _pair(rto=0.05, max_retries=2, echo=False):
+    ports = _free_port(), _free_port()
+    peers = []
+    for name, local, remote in (('a', ports[0], ports[1]), ('b', ports[1], ports[0])):
+        usocket.udp_bindings[('127.0.0.1', remote)] = ('127.0.0.1', local)
+        peer = Peer(name, app=App(UDP_SERVER={
+            'host': '127.0.0.1', 'port': remote, 'timeout': 1, 'window': 8, 'rto': rto, 'max_retries': max_retries
+        }), echo=echo and name == 'b')
+        peer.load()
+        peers.append(peer)
+    return peers[0], peers[1], ports[0]
+
+
+def _data_seq(data):
+    if data[0] != UdpClient.DATA:
+        return None
+    return struct.unpack('>H', data[2:4])[0]
+
+
+def test_permanent_loss_is_skipped():
+    a, b, port = _pair(rto=0.05, max_retries=2)
+    usocket.send_filter = lambda sock, data: not (sock.getsockname()[1] == port and _data_seq(data) == 3)
+    try:
+        messages = [b'msg%d' % i for i in range(12)]
+        for message in messages:
+            assert a.send(message)
+        assert wait(lambda: len(b.received) == 11)
+    finally:
+        usocket.send_filter = None
+    assert b.received == messages[:3] + messages[4:]
+    assert a.stats()['dropped'] == 1
+    assert b.stats()['skipped'] == 1
+    assert wait(lambda: a.stats()['in_flight'] == 0)
+
+
+def test_failed_connect_at_boot_is_retried(monkeypatch):
+    getaddrinfo = usocket.getaddrinfo
+    failures = []
+
+    def flaky_getaddrinfo(host, port):
+        if len(failures) < 2:
+            failures.append(port)
+            raise OSError('dns not ready')
+        return getaddrinfo(host, port)
+
+    monkeypatch.setattr(usocket, 'getaddrinfo', flaky_getaddrinfo)
+    monkeypatch.setattr(DNSCache, 'negative_ttl', 0)
+    ports = _free_port(), _free_port()
+    usocket.udp_bindings[('127.0.0.1', ports[1])] = ('127.0.0.1', ports[0])
+    a = Peer('a', app=App(
+        UDP_SERVER={'host': '127.0.0.1', 'port': ports[1], 'timeout': 1, 'rto': 0.05, 'max_retries': 2},
+        UDP_RECONNECT={'base_delay': 0.05, 'max_delay': 0.1}
+    ))
+    a.load()
+    # circuit open, sends fail fast instead of filling the window
+    assert a.send(b'early') is False
+    assert wait(lambda: a.policy.allow())
+    assert len(failures) == 2
+    usocket.udp_bindings[('127.0.0.1', ports[0])] = ('127.0.0.1', ports[1])
+    b = Peer('b', app=App(UDP_SERVER={'host': '127.0.0.1', 'port': ports[0], 'timeout': 1, 'rto': 0.05}))
+    b.load()
+    assert a.send(b'late')
+    assert wait(lambda: b.received == [b'late'])
+
+
+def test_fast_retransmit_once_per_duplicate_acks():
+    a, b, port = _pair(rto=1, max_retries=2)
+    sent = []
+
+    def lose_first(sock, data):
+        if sock.getsockname()[1] != port or _data_seq(data) != 0:
+            return True
+        sent.append(data)
+        return len(sent) > 1
+
+    usocket.send_filter = lose_first
+    try:
+        messages = [b'msg%d' % i for i in range(8)]
+        for message in messages:
+            assert a.send(message)
+        assert wait(lambda: len(b.received) == 8, timeout=0.9)
+    finally:
+        usocket.send_filter = None
+    assert b.received == messages
+    assert len(sent) == 2
+    assert a.stats()['retransmits'] == 1
+
+
+class EchoServer(TcpServer):
+
+    def recv_callback(self, session, data):
+        self.send(bytes(data))
+
+
+class Client(TcpClient):
+
+    def __init__(self, name, app=None):
+        self.event = threading.Event()
+        super().__init__(name, app=app)
+
+    def recv_callback(self, data):
+        self.event.set()
+
+
+def _round_trips(send, event, count, payload):
+    start = time.time()
+    for _ in range(count):
+        event.clear()
+        send(payload)
+        assert event.wait(2)
+    return time.time() - start
+
+
+def _reset_wire():
+    for kind in usocket.wire_bytes:
+        usocket.wire_bytes[kind] = 0
+        usocket.wire_packets[kind] = 0
+
+
+def test_loopback_benchmark_against_tcp():
+    """time round trips over udp and tcp. the byte counts are estimates from payload bytes, send calls and assumed
+    header sizes, the real segments on the wire are not measured, so they are printed but not compared.
+    """
+    count, payload = 200, b'\x7e' + b'\x00' * 30 + b'\x7e'
+
+    a, b, _ = _pair(rto=0.5, echo=True)
+    _reset_wire()
+    a.event.clear()
+    udp_time = _round_trips(a.send, a.event, count, payload)
+    udp_packets = usocket.wire_packets[socket.SOCK_DGRAM]
+    udp_bytes = usocket.wire_bytes[socket.SOCK_DGRAM] + udp_packets * UDP_OVERHEAD
+
+    server = EchoServer('server', app=App(TCP_LISTEN={'host': '127.0.0.1', 'port': 0, 'max_sessions': 1}))
+    server.load()
+    host, port = server.sock.sock.getsockname()
+    _reset_wire()
+    client = Client('client', app=App(TCP_SERVER={'host': host, 'port': port, 'timeout': 1}))
+    client.load()
+    tcp_time = _round_trips(client.send, client.event, count, payload)
+    # estimate: data segments, one pure ack each, plus the handshake
+    tcp_packets = usocket.wire_packets[socket.SOCK_STREAM] * 2 + 3
+    tcp_bytes = usocket.wire_bytes[socket.SOCK_STREAM] + tcp_packets * TCP_OVERHEAD
+
+    print('\n{} round trips of {} bytes'.format(count, len(payload)))
+    print('udp: {:.3f}s, {} datagrams, estimated {} bytes on the wire'.format(udp_time, udp_packets, udp_bytes))
+    print('tcp: {:.3f}s, estimated {} segments, {} bytes on the wire'.format(tcp_time, tcp_packets, tcp_bytes))
+    assert b.stats()['duplicates'] == 0
+    client.disconnect()
+    server.close()